@@ -3,10 +3,15 @@
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
 index = {"get_subs": "00_core.ipynb",
+         "discover_sessions": "00_core.ipynb",
          "filter_workflow": "00_core.ipynb",
          "get_bfiles_tuple": "00_core.ipynb",
          "get_sub_gradfiles": "00_core.ipynb",
+         "get_sidecar_chain": "00_core.ipynb",
+         "get_sidecar_metadata": "00_core.ipynb",
          "BIDS_metadata": "00_core.ipynb",
+         "BIDSDataSinkInputSpec": "00_core.ipynb",
+         "BIDSDataSink": "00_core.ipynb",
          "PipetographyBaseInputSpec": "00_core.ipynb",
          "MRCatInputSpec": "00_core.ipynb",
          "MRCatOutputSpec": "00_core.ipynb",
@@ -85,12 +90,76 @@ index = {"get_subs": "00_core.ipynb",
          "PreProcNodes": "02_nodes.ipynb",
          "ACPCNodes": "02_nodes.ipynb",
          "PostProcNodes": "02_nodes.ipynb",
-         "connectome": "03_connectomes.ipynb"}
+         "connectome": "03_connectomes.ipynb",
+         "MIFImage": "04_mif.ipynb",
+         "create_mif": "04_mif.ipynb",
+         "load_mif": "04_mif.ipynb",
+         "save_mif": "04_mif.ipynb",
+         "set_dw_scheme": "04_mif.ipynb",
+         "UpdateGradientInputSpec": "05_dwi.ipynb",
+         "UpdateGradientOutputSpec": "05_dwi.ipynb",
+         "UpdateGradient": "05_dwi.ipynb",
+         "MeanB0InputSpec": "05_dwi.ipynb",
+         "MeanB0OutputSpec": "05_dwi.ipynb",
+         "MeanB0": "05_dwi.ipynb",
+         "DTIMetricsInputSpec": "05_dwi.ipynb",
+         "DTIMetricsOutputSpec": "05_dwi.ipynb",
+         "DTIMetrics": "05_dwi.ipynb",
+         "RicianCorrectionInputSpec": "05_dwi.ipynb",
+         "RicianCorrectionOutputSpec": "05_dwi.ipynb",
+         "RicianCorrection": "05_dwi.ipynb",
+         "TckFile": "06_tck.ipynb",
+         "load_tck": "06_tck.ipynb",
+         "save_tck": "06_tck.ipynb",
+         "merge_tck": "06_tck.ipynb",
+         "MergeTracksInputSpec": "06_tck.ipynb",
+         "MergeTracksOutputSpec": "06_tck.ipynb",
+         "MergeTracks": "06_tck.ipynb",
+         "tck_endpoints": "06_tck.ipynb",
+         "load_streamline_values": "07_connectivity.ipynb",
+         "save_streamline_values": "07_connectivity.ipynb",
+         "load_parcellation": "07_connectivity.ipynb",
+         "parcellation_distance": "07_connectivity.ipynb",
+         "load_parcellation_distance": "07_connectivity.ipynb",
+         "ConnectomeAccumulator": "07_connectivity.ipynb",
+         "connectome_matrices": "07_connectivity.ipynb",
+         "save_matrix": "07_connectivity.ipynb",
+         "ConnectomeMatricesInputSpec": "07_connectivity.ipynb",
+         "ConnectomeMatricesOutputSpec": "07_connectivity.ipynb",
+         "ConnectomeMatrices": "07_connectivity.ipynb",
+         "StreamlineEndpointsInputSpec": "07_connectivity.ipynb",
+         "StreamlineEndpointsOutputSpec": "07_connectivity.ipynb",
+         "StreamlineEndpoints": "07_connectivity.ipynb",
+         "ParcellationDistanceInputSpec": "07_connectivity.ipynb",
+         "ParcellationDistanceOutputSpec": "07_connectivity.ipynb",
+         "ParcellationDistance": "07_connectivity.ipynb",
+         "sample_streamlines": "07_connectivity.ipynb",
+         "SampleStreamlinesInputSpec": "07_connectivity.ipynb",
+         "SampleStreamlinesOutputSpec": "07_connectivity.ipynb",
+         "SampleStreamlines": "07_connectivity.ipynb",
+         "ConnectomeStore": "08_cohort.ipynb",
+         "update_cohort_stores": "08_cohort.ipynb",
+         "load_cohort_store": "08_cohort.ipynb",
+         "run_batched": "09_execution.ipynb",
+         "RESOURCE_PROFILES": "09_execution.ipynb",
+         "DEFAULT_PROFILE": "09_execution.ipynb",
+         "apply_resource_profiles": "09_execution.ipynb",
+         "NODE_COSTS": "09_execution.ipynb",
+         "DEFAULT_COST": "09_execution.ipynb",
+         "CLEANUP_KEEP": "09_execution.ipynb",
+         "CLEANUP_MIN_SIZE": "09_execution.ipynb",
+         "CriticalPathPlugin": "09_execution.ipynb"}
 
 modules = ["core.py",
            "pipeline.py",
            "nodes.py",
-           "connectomes.py"]
+           "connectomes.py",
+           "mif.py",
+           "dwi.py",
+           "tck.py",
+           "connectivity.py",
+           "cohort.py",
+           "execution.py"]
 
 doc_url = "https://axiezai.github.io/pipetography/"
 
@@ -0,0 +1,155 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 08_cohort.ipynb (unless otherwise specified).
+
+__all__ = ['ConnectomeStore', 'update_cohort_stores', 'load_cohort_store']
+
+# Internal Cell
+import os
+import json
+import numpy as np
+
+from glob import glob
+
+# Cell
+class ConnectomeStore:
+    """
+    Connectivity matrices of every session of a cohort for one atlas and weighting, as a memory-mapped sessions x regions x regions array
+    Inputs:
+        - path (str): store folder, created on the first `append`
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta_file = os.path.join(path, "store.json")
+        self.index_file = os.path.join(path, "sessions.tsv")
+        self.data_file = os.path.join(path, "matrices.dat")
+        self.meta = {}
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                self.meta = json.load(f)
+
+    @property
+    def n_regions(self):
+        return self.meta.get("n_regions", 0)
+
+    @property
+    def dtype(self):
+        return np.dtype(self.meta.get("dtype", "float32"))
+
+    @property
+    def sessions(self):
+        "(subject, session) of each matrix, in store order"
+        if not os.path.exists(self.index_file):
+            return []
+        with open(self.index_file) as f:
+            return [tuple(line.rstrip("\n").split("\t")) for line in f.readlines()[1:]]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @property
+    def data(self):
+        "read-only memory map of the matrices, sessions x regions x regions"
+        if len(self) == 0:
+            return np.zeros((0, self.n_regions, self.n_regions), dtype=self.dtype)
+        return np.memmap(self.data_file, dtype=self.dtype, mode="r", shape=(len(self), self.n_regions, self.n_regions))
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def matrix(self, subject, session):
+        "matrix of one session"
+        return self.data[self.sessions.index((subject, session))]
+
+    def append(self, sessions, matrices, dtype="float32"):
+        """
+        Add the matrices of new sessions at the end of the store, sessions already in the store are skipped
+        Inputs:
+            - sessions (list): (subject, session) of each matrix
+            - matrices (list or array): regions x regions matrices
+            - dtype (str): data type of a new store
+        """
+        stored = set(self.sessions)
+        new = [(tuple(key), matrix) for key, matrix in zip(sessions, matrices) if tuple(key) not in stored]
+        if not new:
+            return 0
+        if not self.meta:
+            os.makedirs(self.path, exist_ok=True)
+            self.meta = {"n_regions": int(np.shape(new[0][1])[0]), "dtype": np.dtype(dtype).str}
+            with open(self.meta_file, "w") as f:
+                json.dump(self.meta, f)
+            with open(self.index_file, "w") as f:
+                f.write("subject\tsession\n")
+        for key, matrix in new:
+            if np.shape(matrix) != (self.n_regions, self.n_regions):
+                raise ValueError("{}: {} matrix in a store of {} regions".format(key, np.shape(matrix), self.n_regions))
+        # drop the data of an append that didn't finish, then write the matrices before indexing them
+        size = len(stored) * self.n_regions ** 2 * self.dtype.itemsize
+        with open(self.data_file, "ab") as f:
+            f.truncate(size)
+            np.asarray([matrix for _, matrix in new], dtype=self.dtype).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.index_file, "a") as f:
+            f.writelines("{}\t{}\n".format(*key) for key, _ in new)
+        return len(new)
+
+# Internal Cell
+def _find_connectomes(derivatives_dir):
+    "{(atlas, weighting): [(subject, session, matrix file)]} of the connectomes in sub-*/ses-*/connectomes"
+    found = {}
+    pattern = os.path.join(derivatives_dir, "sub-*", "ses-*", "connectomes", "**", "*.csv")
+    for fname in sorted(glob(pattern, recursive=True)):
+        rel = os.path.relpath(fname, derivatives_dir).split(os.sep)
+        subject, session = rel[0][len("sub-") :], rel[1][len("ses-") :]
+        atlas = "/".join(rel[3:-1]) or "atlas"
+        weighting = os.path.splitext(rel[-1])[0]
+        found.setdefault((atlas, weighting), []).append((subject, session, fname))
+    return found
+
+# Cell
+def update_cohort_stores(BIDS_dir, store_dir=None, dtype="float32"):
+    """
+    Append the connectomes of sessions not yet in the cohort stores, one store per atlas and weighting.
+    Returns a dict of `ConnectomeStore` by (atlas, weighting).
+    Inputs:
+        - BIDS_dir (str): base BIDS directory path
+        - store_dir (str): folder of the stores, defaults to derivatives/pipetography/group
+        - dtype (str): data type of new stores
+    """
+    derivatives_dir = os.path.join(BIDS_dir, "derivatives", "pipetography")
+    store_dir = store_dir or os.path.join(derivatives_dir, "group")
+    stores = {}
+    for (atlas, weighting), files in _find_connectomes(derivatives_dir).items():
+        store = ConnectomeStore(os.path.join(store_dir, atlas, weighting))
+        stored = set(store.sessions)
+        sessions, matrices = [], []
+        for subject, session, fname in files:
+            if (subject, session) in stored:
+                continue
+            try:
+                matrix = np.loadtxt(fname, delimiter=",", ndmin=2)
+            except ValueError as e:
+                print("Skipping sub-{}/ses-{} {}/{}: {}".format(subject, session, atlas, weighting, e))
+                continue
+            n_regions = store.n_regions or (len(matrices[0]) if matrices else len(matrix))
+            if matrix.shape != (n_regions, n_regions):
+                print(
+                    "Skipping sub-{}/ses-{} {}/{}: {} matrix in a store of {} regions".format(
+                        subject, session, atlas, weighting, "x".join(map(str, matrix.shape)), n_regions
+                    )
+                )
+                continue
+            sessions.append((subject, session))
+            matrices.append(matrix)
+        store.append(sessions, matrices, dtype=dtype)
+        stores[(atlas, weighting)] = store
+    return stores
+
+def load_cohort_store(store_dir, atlas, weighting="connectome"):
+    """
+    Open the cohort store of an atlas and weighting
+    Inputs:
+        - store_dir (str): folder of the stores, e.g. derivatives/pipetography/group
+        - atlas (str): atlas name
+        - weighting (str): matrix name, `connectome`, `distances` or `FA_weighted`
+    """
+    return ConnectomeStore(os.path.join(store_dir, atlas, weighting))
\ No newline at end of file
@@ -0,0 +1,475 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 07_connectivity.ipynb (unless otherwise specified).
+
+__all__ = ['load_streamline_values', 'save_streamline_values', 'load_parcellation', 'parcellation_distance',
+           'load_parcellation_distance', 'ConnectomeAccumulator', 'connectome_matrices', 'save_matrix',
+           'ConnectomeMatricesInputSpec', 'ConnectomeMatricesOutputSpec', 'ConnectomeMatrices',
+           'StreamlineEndpointsInputSpec', 'StreamlineEndpointsOutputSpec', 'StreamlineEndpoints',
+           'ParcellationDistanceInputSpec', 'ParcellationDistanceOutputSpec', 'ParcellationDistance',
+           'sample_streamlines', 'SampleStreamlinesInputSpec', 'SampleStreamlinesOutputSpec', 'SampleStreamlines']
+
+# Internal Cell
+import os
+import tempfile
+import numpy as np
+from itertools import product
+import nibabel as nb
+from scipy import ndimage
+
+from nipype.interfaces.base import (
+    BaseInterface,
+    BaseInterfaceInputSpec,
+    File,
+    InputMultiObject,
+    OutputMultiObject,
+    TraitedSpec,
+    isdefined,
+    traits,
+)
+from .mif import load_mif
+from .tck import load_tck, tck_endpoints
+
+# Internal Cell
+def _voxel_labels(labels, affine, points):
+    "labels (atlases x points) of the voxel containing each point in stacked atlases x X x Y x Z `labels`, 0 outside"
+    inv_affine = np.linalg.inv(affine)
+    ijk = np.rint(points @ inv_affine[:3, :3].T + inv_affine[:3, 3]).astype(np.int64)
+    inside = np.all((ijk >= 0) & (ijk < labels.shape[1:4]), axis=1)
+    out = np.zeros((len(labels), len(points)), dtype=labels.dtype)
+    out[:, inside] = labels[(slice(None),) + tuple(ijk[inside].T)]
+    return out
+
+def _stack_parcellations(parc_files, search_radius=0, distance_files=None):
+    """
+    group parcellations by voxel grid, as (stacked labels, affine, atlas indices), labels extended by `search_radius` mm
+    using their saved distance transforms, `distance_files`, when given
+    """
+    grids = {}
+    for i, fname in enumerate(parc_files):
+        if search_radius > 0:
+            if distance_files:
+                distance, nearest, affine = load_parcellation_distance(distance_files[i])
+            else:
+                distance, nearest, affine = parcellation_distance(fname)
+            labels = np.where(distance <= search_radius, nearest, 0)
+        else:
+            labels, affine = load_parcellation(fname)
+        key = (labels.shape, np.round(affine, 4).tobytes())
+        grids.setdefault(key, (affine, [], []))
+        grids[key][1].append(labels)
+        grids[key][2].append(i)
+    return [(np.stack(labels), affine, atlases) for affine, labels, atlases in grids.values()]
+
+
+# Cell
+def load_streamline_values(fname):
+    """
+    One value per streamline, memory-mapped from a .npy file or parsed from an MRtrix text file (SIFT2 weights, tcksample output)
+    Inputs:
+        - fname (str): .npy or text file
+    """
+    if fname.endswith(".npy"):
+        return np.load(fname, mmap_mode="r")
+    return np.loadtxt(fname, comments="#", ndmin=1).ravel()
+
+def save_streamline_values(fname, values):
+    "save one value per streamline as `tcksample -stat_tck` does, one per line, and as float32 in a .npy next to it"
+    values = np.asarray(values).ravel()
+    np.savetxt(fname, values, fmt="%.8g")
+    np.save(os.path.splitext(fname)[0] + ".npy", values.astype(np.float32))
+    return os.path.abspath(fname)
+
+
+# Cell
+def load_parcellation(fname):
+    """
+    Integer labels and voxel to scanner affine of a parcellation image
+    Inputs:
+        - fname (str): parcellation NIfTI image
+    """
+    img = nb.load(fname)
+    return np.rint(np.asanyarray(img.dataobj)).astype(np.int32), img.affine
+
+def parcellation_distance(parc_file, distance_file=None):
+    """
+    Distance (mm) from every voxel of a parcellation to the nearest labelled voxel, that voxel's label and the parcellation's affine
+    Inputs:
+        - parc_file (str): parcellation NIfTI image
+        - distance_file (str): if given, the distance transform is saved there, see `load_parcellation_distance`
+    """
+    labels, affine = load_parcellation(parc_file)
+    vox = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    distance, indices = ndimage.distance_transform_edt(labels == 0, sampling=vox, return_indices=True)
+    distance, nearest = distance.astype(np.float32), labels[tuple(indices)]
+    if distance_file:
+        np.savez(distance_file, distance=distance, nearest=nearest, affine=affine)
+    return distance, nearest, affine
+
+def load_parcellation_distance(distance_file):
+    "distance, nearest label and affine saved by `parcellation_distance`"
+    with np.load(distance_file) as saved:
+        return saved["distance"], saved["nearest"], saved["affine"]
+
+class ConnectomeAccumulator:
+    """
+    Accumulates streamline contributions to the edges of a connectome, for matrices matching `tck2connectome -symmetric -zero_diagonal`
+    Inputs:
+        - n_nodes (int): number of parcels, the largest parcellation label
+    """
+    def __init__(self, n_nodes):
+        self.n_nodes = n_nodes
+        size = (n_nodes + 1) ** 2
+        self.weight = np.zeros(size)
+        self.count = np.zeros(size)
+        self.length = np.zeros(size)
+        self.scale = np.zeros(size)
+
+    def add(self, node_a, node_b, weights=None, lengths=None, scale=None):
+        "add streamlines connecting `node_a` to `node_b` (labels, 0 unassigned)"
+        edge = np.minimum(node_a, node_b).astype(np.int64) * (self.n_nodes + 1) + np.maximum(node_a, node_b)
+        weights = np.ones(len(edge)) if weights is None else weights
+        size = len(self.weight)
+        self.weight += np.bincount(edge, weights=weights, minlength=size)
+        self.count += np.bincount(edge, minlength=size)
+        if lengths is not None:
+            self.length += np.bincount(edge, weights=lengths, minlength=size)
+        if scale is not None:
+            self.scale += np.bincount(edge, weights=weights * scale, minlength=size)
+
+    def _matrix(self, values):
+        matrix = values.reshape(self.n_nodes + 1, self.n_nodes + 1)[1:, 1:].copy()
+        np.fill_diagonal(matrix, 0)
+        return np.triu(matrix) + np.triu(matrix, 1).T
+
+    def matrices(self):
+        "weighted streamline count, mean length and weighted mean scale matrices"
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_length = np.where(self.count > 0, self.length / self.count, 0)
+            mean_scale = np.where(self.weight != 0, self.scale / self.weight, 0)
+        return {
+            "count": self._matrix(self.weight),
+            "length": self._matrix(mean_length),
+            "scale": self._matrix(mean_scale),
+        }
+
+# Cell
+def connectome_matrices(
+    tck_file, parc_file, weights=None, scale=None, search_radius=0, distance_file=None, endpoints_file="", batch_size=1000000
+):
+    """
+    Weighted streamline count, mean length and weighted mean scale connectivity matrices, from the endpoints of a tractogram.
+    Returns a dict of matrices, or a list of them when `parc_file` is a list.
+    Inputs:
+        - tck_file (str): tractogram
+        - parc_file (str or list): parcellation image(s), in the tractogram's space
+        - weights (str or array): streamline weights, e.g. SIFT2 output
+        - scale (str or array): value per streamline, e.g. mean FA from `tcksample`
+        - search_radius (float): assign endpoints to the nearest parcel within this distance (mm), 0 for the parcel of the end voxel
+        - distance_file (str or list): distance transform of each parcellation, see `parcellation_distance`, computed if not given
+        - endpoints_file (str): endpoint index of the tractogram, see `tck_endpoints`
+        - batch_size (int): number of streamlines processed at a time
+    """
+    endpoints = tck_endpoints(tck_file, endpoints_file, batch_size)
+    n_streamlines = len(endpoints["length"])
+    parc_files = [parc_file] if isinstance(parc_file, str) else list(parc_file)
+    distance_files = [distance_file] if isinstance(distance_file, str) else distance_file
+    grids = _stack_parcellations(parc_files, search_radius, distance_files)
+    if isinstance(weights, str):
+        weights = load_streamline_values(weights)
+    if isinstance(scale, str):
+        scale = load_streamline_values(scale)
+    for name, values in (("weights", weights), ("scale", scale)):
+        if values is not None and len(values) != n_streamlines:
+            raise ValueError("{} {} for {} streamlines in {}".format(len(values), name, n_streamlines, tck_file))
+    accumulators = [None] * len(parc_files)
+    for labels, _, atlases in grids:
+        for atlas, atlas_labels in zip(atlases, labels):
+            accumulators[atlas] = ConnectomeAccumulator(int(atlas_labels.max()))
+    for first in range(0, n_streamlines, batch_size):
+        batch = slice(first, first + batch_size)
+        valid = endpoints["n_points"][batch] > 0
+        start, end = endpoints["start"][batch][valid], endpoints["end"][batch][valid]
+        batch_weights = None if weights is None else weights[batch][valid]
+        batch_scale = None if scale is None else scale[batch][valid]
+        lengths = endpoints["length"][batch][valid]
+        for labels, affine, atlases in grids:
+            start_labels = _voxel_labels(labels, affine, start)
+            end_labels = _voxel_labels(labels, affine, end)
+            for k, atlas in enumerate(atlases):
+                accumulators[atlas].add(
+                    start_labels[k], end_labels[k], weights=batch_weights, lengths=lengths, scale=batch_scale
+                )
+    matrices = [acc.matrices() for acc in accumulators]
+    if scale is None:
+        for atlas_matrices in matrices:
+            del atlas_matrices["scale"]
+    return matrices[0] if isinstance(parc_file, str) else matrices
+
+def save_matrix(fname, matrix):
+    "save a connectivity matrix as MRtrix does, comma separated for .csv files"
+    np.savetxt(fname, matrix, fmt="%.10g", delimiter="," if fname.endswith(".csv") else " ")
+    return os.path.abspath(fname)
+
+# Cell
+class ConnectomeMatricesInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input tck file")
+    in_endpoints = File(exists=True, desc="endpoint index of in_file, created next to in_file if not given")
+    in_parc = InputMultiObject(File(exists=True), mandatory=True, desc="parcellation file(s)")
+    atlas_names = traits.List(
+        traits.Str, desc="name of each parcellation, outputs are written to `_atlas_<name>` folders. Defaults to the file names"
+    )
+    in_weights = File(exists=True, desc="streamline weights, e.g. from SIFT2, as text or .npy")
+    scale_file = File(exists=True, desc="value per streamline (e.g. mean FA) averaged in out_scale, as text or .npy")
+    out_count = File("connectome.csv", usedefault=True, desc="weighted streamline count matrix")
+    out_length = File("distances.csv", usedefault=True, desc="mean streamline length matrix")
+    out_scale = File("FA_weighted.csv", usedefault=True, desc="weighted mean of scale_file matrix")
+    search_radius = traits.Float(
+        0.0, usedefault=True, desc="assign endpoints to the nearest parcel within this distance (mm), 0 for the end voxel's parcel"
+    )
+    in_distance = InputMultiObject(
+        File(exists=True), desc="distance transform of each parcellation, from ParcellationDistance, computed if not given"
+    )
+    batch_size = traits.Int(1000000, usedefault=True, nohash=True, desc="streamlines read at a time")
+
+class ConnectomeMatricesOutputSpec(TraitedSpec):
+    out_count = OutputMultiObject(File(exists=True), desc="weighted streamline count matrices")
+    out_length = OutputMultiObject(File(exists=True), desc="mean streamline length matrices")
+    out_scale = OutputMultiObject(File(), desc="weighted mean of scale_file matrices")
+
+class ConnectomeMatrices(BaseInterface):
+    """
+    Count, length and scale (e.g. FA) weighted connectomes of one or more parcellations, from a single pass over the tractogram
+    """
+    input_spec = ConnectomeMatricesInputSpec
+    output_spec = ConnectomeMatricesOutputSpec
+
+    def _atlas_dirs(self):
+        "one `_atlas_<name>` folder per parcellation, however many there are, so the sinked layout is always connectomes/<atlas>"
+        names = self.inputs.atlas_names if isdefined(self.inputs.atlas_names) else []
+        if len(names) != len(self.inputs.in_parc):
+            names = [os.path.basename(parc).split(".")[0] for parc in self.inputs.in_parc]
+        if len(set(names)) != len(names):
+            names = [str(i) for i in range(len(names))]
+        return [os.path.abspath("_atlas_{}".format(name)) for name in names]
+
+    def _run_interface(self, runtime):
+        matrices = connectome_matrices(
+            self.inputs.in_file,
+            list(self.inputs.in_parc),
+            weights=self.inputs.in_weights if isdefined(self.inputs.in_weights) else None,
+            scale=self.inputs.scale_file if isdefined(self.inputs.scale_file) else None,
+            search_radius=self.inputs.search_radius,
+            distance_file=list(self.inputs.in_distance) if isdefined(self.inputs.in_distance) else None,
+            endpoints_file=self.inputs.in_endpoints if isdefined(self.inputs.in_endpoints) else "",
+            batch_size=self.inputs.batch_size,
+        )
+        for atlas_dir, atlas_matrices in zip(self._atlas_dirs(), matrices):
+            os.makedirs(atlas_dir, exist_ok=True)
+            for name, matrix in atlas_matrices.items():
+                save_matrix(os.path.join(atlas_dir, getattr(self.inputs, "out_" + name)), matrix)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        names = ["count", "length"] + (["scale"] if isdefined(self.inputs.scale_file) else [])
+        for name in names:
+            fname = getattr(self.inputs, "out_" + name)
+            outputs["out_" + name] = [os.path.join(atlas_dir, fname) for atlas_dir in self._atlas_dirs()]
+        return outputs
+
+# Cell
+class StreamlineEndpointsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input tck file")
+    out_file = File(desc="endpoint index, defaults to <in_file>.endpoints.npz next to the tractogram")
+
+class StreamlineEndpointsOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="endpoint index")
+
+class StreamlineEndpoints(BaseInterface):
+    """
+    Create the endpoint index of a tractogram: first and last point, length and number of points of every streamline
+    """
+    input_spec = StreamlineEndpointsInputSpec
+    output_spec = StreamlineEndpointsOutputSpec
+
+    def _out_file(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        out_file = os.path.abspath(self.inputs.in_file) + ".endpoints.npz"
+        if not os.access(os.path.dirname(os.path.abspath(out_file)), os.W_OK):
+            out_file = os.path.abspath(os.path.basename(out_file))
+        return out_file
+
+    def _run_interface(self, runtime):
+        tck_endpoints(self.inputs.in_file, self._out_file())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["out_file"] = self._out_file()
+        return outputs
+
+class ParcellationDistanceInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="parcellation image")
+    out_file = File(desc="distance transform, defaults to <in_file name>.distance.npz in the working directory")
+
+class ParcellationDistanceOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="distance transform")
+
+class ParcellationDistance(BaseInterface):
+    """
+    Distance transform and nearest label map of a parcellation, for the radial search of `ConnectomeMatrices`
+    """
+    input_spec = ParcellationDistanceInputSpec
+    output_spec = ParcellationDistanceOutputSpec
+
+    def _out_file(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        return os.path.abspath(os.path.basename(self.inputs.in_file).split(".")[0] + ".distance.npz")
+
+    def _run_interface(self, runtime):
+        parcellation_distance(self.inputs.in_file, self._out_file())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["out_file"] = self._out_file()
+        return outputs
+
+# Internal Cell
+def _load_metric(fname, tmp_dir=None):
+    """
+    memory-mapped data and voxel to scanner affine of a .mif/.mih or NIfTI image.
+    Compressed images are decompressed once into an unlinked temporary file in `tmp_dir` (the working directory by default)
+    """
+    if fname.endswith((".mif", ".mih")):
+        img = load_mif(fname)
+        return img.data, img.affine
+    img = nb.load(fname, mmap=True)
+    if not fname.endswith(".gz"):
+        return np.asanyarray(img.dataobj), img.affine
+    data = img.get_fdata(dtype=np.float32)
+    with tempfile.TemporaryFile(dir=tmp_dir or os.getcwd()) as f:
+        # the mapping keeps the file's pages alive once it is closed and unlinked
+        mapped = np.memmap(f, dtype=np.float32, mode="w+", shape=data.shape)
+    mapped[:] = data
+    return mapped, img.affine
+
+def _load_metrics(metric_files, tmp_dir=None):
+    "memory-mapped X x Y x Z volume of each metric image, and their common affine"
+    volumes, affine = [], None
+    for fname in metric_files:
+        data, img_affine = _load_metric(fname, tmp_dir)
+        if affine is None:
+            affine = img_affine
+        elif tuple(data.shape[:3]) != volumes[0].shape or not np.allclose(img_affine, affine, atol=1e-4):
+            raise ValueError("{} is not on the voxel grid of {}".format(fname, metric_files[0]))
+        if np.prod(data.shape[3:], dtype=int) != 1:
+            raise ValueError("{} has more than one volume".format(fname))
+        # a view of the 3D volume, so the data stays mapped
+        volumes.append(data[(slice(None),) * 3 + (0,) * (data.ndim - 3)])
+    return volumes, affine
+
+def _interpolate(volumes, affine, points):
+    "trilinear interpolation of every metric volume at `points` (mm), NaN outside the image"
+    inv_affine = np.linalg.inv(affine)
+    ijk = points @ inv_affine[:3, :3].T + inv_affine[:3, 3]
+    shape = np.array(volumes[0].shape)
+    inside = np.all((ijk > -0.5) & (ijk < shape - 0.5), axis=1)
+    ijk = np.clip(ijk, 0, shape - 1)
+    low = np.clip(np.floor(ijk).astype(np.int64), 0, np.maximum(shape - 2, 0))
+    high = np.minimum(low + 1, shape - 1)
+    frac = ijk - low
+    values = np.zeros((len(points), len(volumes)))
+    for corner in product((False, True), repeat=3):
+        index = np.where(corner, high, low)
+        weight = np.prod(np.where(corner, frac, 1 - frac), axis=1)
+        for k, volume in enumerate(volumes):
+            values[:, k] += weight * volume[index[:, 0], index[:, 1], index[:, 2]]
+    values[~inside] = np.nan
+    return values
+
+def _streamline_stats(values, offsets):
+    "mean, min and max over the points of each streamline (given by `offsets`) inside the image, 0 when there are none"
+    n_streamlines = len(offsets) - 1
+    streamline = np.repeat(np.arange(n_streamlines), np.diff(offsets))
+    inside = ~np.isnan(values[:, 0])
+    streamline, values = streamline[inside], values[inside]
+    counts = np.bincount(streamline, minlength=n_streamlines)
+    stats = {stat: np.zeros((n_streamlines, values.shape[1])) for stat in ("mean", "min", "max")}
+    # points are ordered by streamline, so every streamline is a contiguous run of `values`
+    sampled = counts > 0
+    starts = (np.cumsum(counts) - counts)[sampled]
+    if len(starts):
+        stats["mean"][sampled] = np.add.reduceat(values, starts, axis=0) / counts[sampled, None]
+        stats["min"][sampled] = np.minimum.reduceat(values, starts, axis=0)
+        stats["max"][sampled] = np.maximum.reduceat(values, starts, axis=0)
+    return stats
+
+# Cell
+def sample_streamlines(tck_file, metric_files, stats=("mean", "min", "max"), batch_size=100000):
+    """
+    Mean, min and max of metric images along every streamline of a tractogram, with all metrics sampled in one pass.
+    Returns a dict with a streamlines x metrics array per statistic.
+    Inputs:
+        - tck_file (str): tractogram
+        - metric_files (str or list): metric images (.mif, .mih or NIfTI) on the same voxel grid, in the tractogram's space
+        - stats (list): statistics to compute, of 'mean', 'min' and 'max'
+        - batch_size (int): number of streamlines processed at a time
+    """
+    metric_files = [metric_files] if isinstance(metric_files, str) else list(metric_files)
+    volumes, affine = _load_metrics(metric_files)
+    tck = load_tck(tck_file)
+    out = {stat: np.zeros((len(tck), len(metric_files)), dtype=np.float32) for stat in stats}
+    for first, points, offsets in tck.batches(batch_size):
+        batch_stats = _streamline_stats(_interpolate(volumes, affine, points), offsets)
+        for stat in stats:
+            out[stat][first : first + len(offsets) - 1] = batch_stats[stat]
+    return out
+
+# Cell
+class SampleStreamlinesInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input tck file")
+    in_metrics = InputMultiObject(File(exists=True), mandatory=True, desc="metric images on the same voxel grid")
+    metric_names = traits.List(traits.Str, desc="name of each metric in output file names, defaults to the image names")
+    stats = traits.List(
+        traits.Enum("mean", "min", "max"), value=["mean", "min", "max"], usedefault=True, desc="statistics per streamline"
+    )
+    batch_size = traits.Int(100000, usedefault=True, nohash=True, desc="streamlines read at a time")
+
+class SampleStreamlinesOutputSpec(TraitedSpec):
+    out_mean = OutputMultiObject(File(), desc="mean of each metric per streamline, <metric>_mean.txt")
+    out_min = OutputMultiObject(File(), desc="minimum of each metric per streamline, <metric>_min.txt")
+    out_max = OutputMultiObject(File(), desc="maximum of each metric per streamline, <metric>_max.txt")
+    out_mean_npy = OutputMultiObject(File(), desc="out_mean as float32 .npy files")
+    out_min_npy = OutputMultiObject(File(), desc="out_min as float32 .npy files")
+    out_max_npy = OutputMultiObject(File(), desc="out_max as float32 .npy files")
+
+class SampleStreamlines(BaseInterface):
+    """
+    Mean, min and max of several metrics per streamline, from a single pass over the tractogram
+    """
+    input_spec = SampleStreamlinesInputSpec
+    output_spec = SampleStreamlinesOutputSpec
+
+    def _out_files(self, stat):
+        names = self.inputs.metric_names if isdefined(self.inputs.metric_names) else []
+        if len(names) != len(self.inputs.in_metrics):
+            names = [os.path.basename(fname).split(".")[0] for fname in self.inputs.in_metrics]
+        return [os.path.abspath("{}_{}.txt".format(name, stat)) for name in names]
+
+    def _run_interface(self, runtime):
+        stats = sample_streamlines(
+            self.inputs.in_file, list(self.inputs.in_metrics), stats=self.inputs.stats, batch_size=self.inputs.batch_size
+        )
+        for stat, values in stats.items():
+            for out_file, metric_values in zip(self._out_files(stat), values.T):
+                save_streamline_values(out_file, metric_values)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        for stat in self.inputs.stats:
+            outputs["out_" + stat] = self._out_files(stat)
+            outputs["out_{}_npy".format(stat)] = [os.path.splitext(fname)[0] + ".npy" for fname in self._out_files(stat)]
+        return outputs
\ No newline at end of file
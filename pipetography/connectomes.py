@@ -11,6 +11,7 @@ from nipype.pipeline import Node, Workflow
 
 import pipetography.nodes as nodes
 import pipetography.core as ppt
+from .execution import run_batched, apply_resource_profiles, CriticalPathPlugin, _batch_share
 
 # Cell
 
@@ -23,10 +24,15 @@ class connectome:
          - atlas_list (List of strings): names of atlases: aal, brainnectome, desikan-killiany, default is set to brainnectome for now.
          - FA (bool): Default = True; if True, additionally creates an FA weighted connectome.
          - SIFT_mask (bool): Uses 5ttgen tissue segmentation during SIFT2. Defaults to False. If in pipeline `gmwmi = False`, this should also be false.
+         - template (str): Default = None; path to a template (e.g. MNI T1 brain) in the atlases' space. If given, the template is registered to each session's DWI once and every atlas is warped with that transform, instead of registering every atlas.
+         - n_streamlines (int): Default = None; if given, generates the tractogram (seeded in the GMWMI mask from `pipeline(gmwmi=True)`) instead of reading it from `derivatives/streamlines`, and saves it there.
+         - n_shards (int): Default = 8; number of independently seeded `tckgen` nodes the streamlines are split into, merged into one tractogram afterwards.
+         - native (bool): Default = False; if True, computes the connectomes of every atlas in a single pass over the streamlines with `connectivity.ConnectomeMatrices` instead of one `tck2connectome` per atlas and weighting. Endpoints are assigned to the nearest parcel within 4mm, as `tck2connectome` does by default, from a distance transform computed once per warped atlas. Mean FA per streamline is sampled with `connectivity.SampleStreamlines` instead of `tcksample`.
          - debug (bool): Default = False; if True, saves node outputs and log files.
+         - sink_transfer (str): Default = "copy"; how outputs are placed in the derivatives folders, see `core.BIDSDataSink`. "hardlink" avoids writing the tractogram twice, but the derivatives then share their data with the working directory files.
     """
 
-    def __init__(self, BIDS_dir, atlas_list, FA=True, SIFT_mask=False, skip_tuples=[()], debug=False):
+    def __init__(self, BIDS_dir, atlas_list, FA=True, SIFT_mask=False, skip_tuples=[()], template=None, native=False, n_streamlines=None, n_shards=8, debug=False, sink_transfer='copy'):
         """
         Initialize workflow nodes
         """
@@ -35,8 +41,13 @@ class connectome:
         self.sub_list, self.ses_list, self.layout = ppt.get_subs(BIDS_dir)
         self.FA = FA,
         self.SIFT_mask = SIFT_mask
+        self.template = template
+        self.native = native
+        self.n_streamlines = n_streamlines
+        self.n_shards = n_shards
         self.skip_combos = skip_tuples
         self.debug_mode = debug
+        self.sink_transfer = sink_transfer
         self.subject_template = {
             'tck': os.path.join(self.bids_dir, 'derivatives', 'streamlines','sub-{subject_id}', 'ses-{session_id}', 'sub-{subject_id}_ses-{session_id}_gmwmi2wm.tck'),
             'brain': os.path.join(self.bids_dir, 'derivatives', 'pipetography', 'sub-{subject_id}', 'ses-{session_id}', 'preprocessed', 'dwi_space-acpc_res-1mm_seg-brain.nii.gz'),
@@ -45,6 +56,10 @@ class connectome:
             'mask': os.path.join(self.bids_dir, 'derivatives', 'pipetography', 'sub-{subject_id}', 'ses-{session_id}', 'preprocessed', 'dwi_space-acpc_res-1mm_seg-brain_mask.nii.gz'),
         }
 
+        if self.n_streamlines:
+            del self.subject_template['tck']
+            self.subject_template['gmwmi'] = os.path.join(self.bids_dir, 'derivatives', 'pipetography', 'sub-{subject_id}', 'ses-{session_id}', 'preprocessed', 'T1w_space-acpc_seg-gmwmi_mask.nii.gz')
+
         if self.SIFT_mask:
             self.subject_template['mrtrix5tt'] = os.path.join(self.bids_dir, 'derivatives', 'pipetography', 'sub-{subject_id}', 'ses-{session_id}', 'preprocessed', 'T1w_space-acpc_seg-5tt.mif')
 
@@ -58,7 +73,25 @@ class connectome:
             sub_list = self.sub_list,
             ses_list = self.ses_list,
             skip_tuples = self.skip_combos)
-        self.PostProcNodes.linear_reg.iterables = [('moving_image', self.atlas_list)]
+        self.PostProcNodes.datasink.inputs.transfer = self.sink_transfer
+        self.PostProcNodes.tck_sink.inputs.transfer = self.sink_transfer
+        if self.template:
+            # SyN runs once per session, atlases only go through ApplyTransforms
+            self.PostProcNodes.template_reg.inputs.moving_image = self.template
+            self.PostProcNodes.warp_atlas.iterables = [('input_image', self.atlas_list)]
+            self.PostProcNodes.connectome_matrices.joinsource = self.PostProcNodes.warp_atlas
+        else:
+            self.PostProcNodes.linear_reg.iterables = [('moving_image', self.atlas_list)]
+        if self.n_streamlines:
+            # shard i tracks its share of the streamlines with MRTRIX_RNG_SEED=i+1
+            shards = min(self.n_shards, self.n_streamlines)
+            self.PostProcNodes.tckgen.inputs.select = [
+                self.n_streamlines // shards + (i < self.n_streamlines % shards) for i in range(shards)
+            ]
+            self.PostProcNodes.tckgen.inputs.environ = [{'MRTRIX_RNG_SEED': str(i + 1)} for i in range(shards)]
+        self.PostProcNodes.connectome_matrices.inputs.atlas_names = [
+            os.path.basename(atlas).split('.nii')[0] for atlas in self.atlas_list
+        ]
         self.workflow = None
 
 
@@ -71,45 +104,99 @@ class connectome:
             [
                 (self.PostProcNodes.subject_source, self.PostProcNodes.select_files, [('subject_id', 'subject_id'),
                                                                                       ('session_id', 'session_id')]),
-                (self.PostProcNodes.select_files, self.PostProcNodes.linear_reg, [('brain', 'fixed_image')]),
-                (self.PostProcNodes.linear_reg, self.PostProcNodes.nonlinear_reg, [('warped_image', 'moving_image')]),
-                (self.PostProcNodes.select_files, self.PostProcNodes.nonlinear_reg, [('brain', 'fixed_image')]),
-                (self.PostProcNodes.nonlinear_reg, self.PostProcNodes.connectome, [('warped_image', 'in_parc')]),
-                (self.PostProcNodes.nonlinear_reg, self.PostProcNodes.distance, [('warped_image', 'in_parc')]),
                 (self.PostProcNodes.select_files, self.PostProcNodes.response, [('dwi_mif', 'in_file')]),
                 (self.PostProcNodes.select_files, self.PostProcNodes.fod, [('dwi_mif', 'in_file')]),
                 (self.PostProcNodes.select_files, self.PostProcNodes.fod, [('mask', 'mask_file')]),
                 (self.PostProcNodes.response, self.PostProcNodes.fod, [('wm_file', 'wm_txt')]),
                 (self.PostProcNodes.response, self.PostProcNodes.fod, [('gm_file', 'gm_txt')]),
                 (self.PostProcNodes.response, self.PostProcNodes.fod, [('csf_file', 'csf_txt')]),
-                (self.PostProcNodes.select_files, self.PostProcNodes.sift2, [('tck', 'in_file')]),
-                (self.PostProcNodes.fod, self.PostProcNodes.sift2, [('wm_odf', 'in_fod')]),
-                (self.PostProcNodes.sift2, self.PostProcNodes.connectome, [('out_file', 'in_weights')]),
-                (self.PostProcNodes.select_files, self.PostProcNodes.connectome, [('tck', 'in_file')]),
-                (self.PostProcNodes.select_files, self.PostProcNodes.distance, [('tck', 'in_file')]),
-                (self.PostProcNodes.connectome, self.PostProcNodes.datasink, [('out_file', 'connectomes.@connectome')]),
-                (self.PostProcNodes.distance, self.PostProcNodes.datasink, [('out_file', 'connectomes.@distance')])
+                                (self.PostProcNodes.fod, self.PostProcNodes.sift2, [('wm_odf', 'in_fod')]),
             ])
+        if self.n_streamlines:
+            self.workflow.connect(
+                [
+                    (self.PostProcNodes.fod, self.PostProcNodes.tckgen, [('wm_odf', 'in_file')]),
+                    (self.PostProcNodes.select_files, self.PostProcNodes.tckgen, [('gmwmi', 'seed_image')]),
+                    (self.PostProcNodes.tckgen, self.PostProcNodes.merge_tck, [('out_file', 'in_files')]),
+                    (self.PostProcNodes.merge_tck, self.PostProcNodes.tck_sink, [('out_file', 'tractography.@tck')]),
+                ])
+            tck_node, tck_field = self.PostProcNodes.merge_tck, 'out_file'
+        else:
+            tck_node, tck_field = self.PostProcNodes.select_files, 'tck'
+        self.workflow.connect([(tck_node, self.PostProcNodes.sift2, [(tck_field, 'in_file')])])
+        if self.template:
+            self.workflow.connect(
+                [
+                    (self.PostProcNodes.select_files, self.PostProcNodes.template_reg, [('brain', 'fixed_image')]),
+                    (self.PostProcNodes.template_reg, self.PostProcNodes.warp_atlas, [('composite_transform', 'transforms')]),
+                    (self.PostProcNodes.select_files, self.PostProcNodes.warp_atlas, [('brain', 'reference_image')]),
+                ])
+            parc_node, parc_field = self.PostProcNodes.warp_atlas, 'output_image'
+        else:
+            self.workflow.connect(
+                [
+                    (self.PostProcNodes.select_files, self.PostProcNodes.linear_reg, [('brain', 'fixed_image')]),
+                    (self.PostProcNodes.linear_reg, self.PostProcNodes.nonlinear_reg, [('warped_image', 'moving_image')]),
+                    (self.PostProcNodes.select_files, self.PostProcNodes.nonlinear_reg, [('brain', 'fixed_image')]),
+                ])
+            parc_node, parc_field = self.PostProcNodes.nonlinear_reg, 'warped_image'
+        if self.native:
+            self.workflow.connect(
+                [
+                    (parc_node, self.PostProcNodes.connectome_matrices, [(parc_field, 'in_parc')]),
+                    (self.PostProcNodes.sift2, self.PostProcNodes.connectome_matrices, [('out_npy', 'in_weights')]),
+                    (tck_node, self.PostProcNodes.connectome_matrices, [(tck_field, 'in_file')]),
+                    (tck_node, self.PostProcNodes.endpoints, [(tck_field, 'in_file')]),
+                    (parc_node, self.PostProcNodes.parc_distance, [(parc_field, 'in_file')]),
+                    (self.PostProcNodes.parc_distance, self.PostProcNodes.connectome_matrices, [('out_file', 'in_distance')]),
+                    (self.PostProcNodes.endpoints, self.PostProcNodes.connectome_matrices, [('out_file', 'in_endpoints')]),
+                    (self.PostProcNodes.connectome_matrices, self.PostProcNodes.datasink, [('out_count', 'connectomes.@connectome')]),
+                    (self.PostProcNodes.connectome_matrices, self.PostProcNodes.datasink, [('out_length', 'connectomes.@distance')])
+                ])
+        else:
+            self.workflow.connect(
+                [
+                    (parc_node, self.PostProcNodes.connectome, [(parc_field, 'in_parc')]),
+                    (parc_node, self.PostProcNodes.distance, [(parc_field, 'in_parc')]),
+                    (self.PostProcNodes.sift2, self.PostProcNodes.connectome, [('out_file', 'in_weights')]),
+                    (tck_node, self.PostProcNodes.connectome, [(tck_field, 'in_file')]),
+                    (tck_node, self.PostProcNodes.distance, [(tck_field, 'in_file')]),
+                    (self.PostProcNodes.connectome, self.PostProcNodes.datasink, [('out_file', 'connectomes.@connectome')]),
+                    (self.PostProcNodes.distance, self.PostProcNodes.datasink, [('out_file', 'connectomes.@distance')])
+                ])
         if self.SIFT_mask:
             self.workflow.connect(
             [
                 (self.PostProcNodes.select_files, self.PostProcNodes.sift2, [('mrtrix5tt', 'act')])
             ])
             self.PostProcNodes.sift2.inputs.fd_scale_gm=True
+            if self.n_streamlines:
+                self.workflow.connect([(self.PostProcNodes.select_files, self.PostProcNodes.tckgen, [('mrtrix5tt', 'act_file')])])
 
         if self.FA:
             self.workflow.connect(
                 [
-                    (self.PostProcNodes.select_files, self.PostProcNodes.fit_tensor, [('dwi_mif','in_file')]),
-                    (self.PostProcNodes.fit_tensor, self.PostProcNodes.tensor_FA, [('out_file','in_file')]),
-                    (self.PostProcNodes.tensor_FA, self.PostProcNodes.tcksample, [('out_fa','in_metric')]),
-                    (self.PostProcNodes.select_files, self.PostProcNodes.tcksample, [('tck','in_file')]),
-                    (self.PostProcNodes.tcksample, self.PostProcNodes.FA_weighted, [('out_file','scale_file')]),
-                    (self.PostProcNodes.nonlinear_reg, self.PostProcNodes.FA_weighted, [('warped_image', 'in_parc')]),
-                    (self.PostProcNodes.sift2, self.PostProcNodes.FA_weighted, [('out_file', 'in_weights')]),
-                    (self.PostProcNodes.select_files, self.PostProcNodes.FA_weighted, [('tck', 'in_file')]),
-                    (self.PostProcNodes.FA_weighted, self.PostProcNodes.datasink,[('out_file','connectomes.@FA_weighted')])
+                    (self.PostProcNodes.select_files, self.PostProcNodes.tensor_FA, [('dwi_mif','in_file')]),
                 ])
+            if self.native:
+                self.workflow.connect(
+                    [
+                        (self.PostProcNodes.tensor_FA, self.PostProcNodes.sample_metrics, [('out_fa','in_metrics')]),
+                        (tck_node, self.PostProcNodes.sample_metrics, [(tck_field, 'in_file')]),
+                        (self.PostProcNodes.sample_metrics, self.PostProcNodes.connectome_matrices, [('out_mean_npy','scale_file')]),
+                        (self.PostProcNodes.connectome_matrices, self.PostProcNodes.datasink, [('out_scale','connectomes.@FA_weighted')])
+                    ])
+            else:
+                self.workflow.connect(
+                    [
+                        (self.PostProcNodes.tensor_FA, self.PostProcNodes.tcksample, [('out_fa','in_metric')]),
+                        (tck_node, self.PostProcNodes.tcksample, [(tck_field, 'in_file')]),
+                        (self.PostProcNodes.tcksample, self.PostProcNodes.FA_weighted, [('out_file','scale_file')]),
+                        (parc_node, self.PostProcNodes.FA_weighted, [(parc_field, 'in_parc')]),
+                        (self.PostProcNodes.sift2, self.PostProcNodes.FA_weighted, [('out_file', 'in_weights')]),
+                        (tck_node, self.PostProcNodes.FA_weighted, [(tck_field, 'in_file')]),
+                        (self.PostProcNodes.FA_weighted, self.PostProcNodes.datasink,[('out_file','connectomes.@FA_weighted')])
+                    ])
 
         if self.debug_mode:
             self.workflow.config["execution"] = {
@@ -135,13 +222,50 @@ class connectome:
             ),
         )
 
-    def run_pipeline(self, parallel=None):
+    def run_pipeline(self, parallel=None, batch_size=None, batches_in_flight=1, memory_gb=None, profiles=None, critical_path=False, max_sessions=None, cleanup=False, scheduler_args=None):
         """
         Run nipype workflow
+        Inputs:
+            - parallel (int): number of CPUs shared by the nodes running in parallel, runs serially if None
+            - batch_size (int): if given, runs the sessions in batches of this size so only a batch's graph is expanded at a time, see `execution.run_batched`
+            - batches_in_flight (int): number of batches running at once, sharing the `parallel` processes
+            - memory_gb (float): memory shared by the nodes running in parallel, defaults to what nipype detects. Node memory profiles are capped to it
+            - profiles (dict): with `parallel`, {node name: (threads, mem_gb, io_weight)} overriding `execution.RESOURCE_PROFILES`
+            - critical_path (bool): with `parallel`, starts the nodes with the longest remaining path first, see `execution.CriticalPathPlugin`
+            - max_sessions (int): with `parallel`, number of sessions in flight, each session finishes before new ones start
+            - cleanup (bool): with `parallel`, deletes the large outputs of each node once the nodes using them are done, instead of removing node directories at the end
+            - scheduler_args (dict): `CriticalPathPlugin` arguments, e.g. {"history_file": "runtimes.json", "io_slots": 2}
         """
         if type(parallel) == int:
             print("Running workflow with {} parallel processes".format(parallel))
-            self.workflow.run('MultiProc', plugin_args = {'n_procs': parallel})
+            plugin, plugin_args = 'MultiProc', {'n_procs': parallel}
+            if memory_gb:
+                plugin_args['memory_gb'] = memory_gb
+            if critical_path or max_sessions or cleanup:
+                plugin = CriticalPathPlugin
+                plugin_args['max_sessions'] = max_sessions
+                plugin_args['cleanup'] = cleanup
+                plugin_args.update(scheduler_args or {})
+            if cleanup:
+                self.workflow.config['execution']['remove_node_directories'] = 'False'
+            # batches in flight split the CPUs and memory, see `execution.run_batched`
+            n_procs, node_memory_gb = _batch_share(parallel, memory_gb, batches_in_flight if batch_size else 1)
+            apply_resource_profiles(self.workflow, n_procs=n_procs, memory_gb=node_memory_gb, profiles=profiles)
         elif parallel is None:
             print("Parallel processing disabled, running workflow serially")
-            self.workflow.run()
\ No newline at end of file
+            plugin, plugin_args = 'Linear', {}
+        else:
+            raise ValueError("parallel must be a number of processes or None, not {!r}".format(parallel))
+        if batch_size:
+            print("Running sessions in batches of {}".format(batch_size))
+            run_batched(
+                self.workflow,
+                self.PostProcNodes.subject_source,
+                self.PostProcNodes.sub_ses,
+                batch_size=batch_size,
+                batches_in_flight=batches_in_flight,
+                plugin=plugin,
+                plugin_args=plugin_args,
+            )
+        else:
+            self.workflow.run(plugin if isinstance(plugin, str) else plugin(plugin_args=plugin_args), plugin_args=plugin_args)
\ No newline at end of file
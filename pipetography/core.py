@@ -1,6 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 00_core.ipynb (unless otherwise specified).
 
-__all__ = ['get_subs', 'filter_workflow', 'get_bfiles_tuple', 'get_sub_gradfiles', 'BIDS_metadata']
+__all__ = ['get_subs', 'discover_sessions', 'filter_workflow', 'get_bfiles_tuple', 'get_sub_gradfiles',
+           'get_sidecar_chain', 'get_sidecar_metadata', 'BIDS_metadata', 'BIDSDataSink']
 
 # Internal Cell
 import os, sys
@@ -10,6 +11,7 @@ from nipype.interfaces.io import BIDSDataGrabber
 from bids.layout import BIDSLayout
 from itertools import product
 
+import numpy as np
 import nibabel as nb
 from nilearn import plotting
 from nilearn.image import new_img_like
@@ -20,32 +22,176 @@ from nipype.interfaces.mrtrix3.utils import BrainMask, TensorMetrics, DWIExtract
 from nipype.interfaces.mrtrix3.preprocess import MRDeGibbs, DWIBiasCorrect
 from nipype.interfaces.mrtrix3.reconst import FitTensor
 
+# Internal Cell
+import hashlib, json, re, shutil, tempfile
+
+_INDEX_VERSION = 1
+_LAYOUT_IGNORE = ["code", "derivatives", "sourcedata", "stimuli", "models"]
+
+def _refresh_dir_index(root, rel, old_dirs, new_dirs, ignore):
+    """
+    Record `rel`'s mtime and sub-directories in `new_dirs`, only listing it again when its mtime changed.
+    Returns True if anything under `rel` changed since `old_dirs` was written.
+    """
+    path = os.path.join(root, rel) if rel else root
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        # removed while we were walking the tree
+        return True
+    old = old_dirs.get(rel)
+    if old is not None and old[0] == mtime:
+        children, changed = old[1], False
+    else:
+        with os.scandir(path) as entries:
+            children = sorted(
+                entry.name for entry in entries
+                if entry.is_dir() and not entry.name.startswith('.')
+                and not (not rel and entry.name in ignore)
+            )
+        changed = True
+    new_dirs[rel] = (mtime, children)
+    for child in children:
+        child_rel = os.path.join(rel, child) if rel else child
+        changed |= _refresh_dir_index(root, child_rel, old_dirs, new_dirs, ignore)
+    return changed
+
+class _LazyLayout:
+    """Builds, or loads from its database, the `BIDSLayout` of a dataset on first attribute access"""
+    def __init__(self, root, database_path, ignore):
+        self._root = root
+        self._database_path = database_path
+        self._ignore = ignore
+        self._layout = None
+
+    def _load(self):
+        if self._layout is None:
+            from bids.layout import BIDSLayoutIndexer
+            print('Creating layout of data directory, might take a while if there are a lot of subjects')
+            self._layout = BIDSLayout(
+                self._root,
+                database_path=self._database_path,
+                indexer=BIDSLayoutIndexer(ignore=self._ignore + [re.compile(r"/\.")]),
+            )
+        return self._layout
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
 # Cell
-def get_subs(BIDS_dir="BIDS_dir"):
+def _default_index_dir(BIDS_dir):
+    "per-dataset folder of the user's cache directory"
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    key = hashlib.sha1(os.path.realpath(BIDS_dir).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'pipetography', 'layout_index', key)
+
+def _writable_dir(path):
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(path, os.W_OK)
+
+def get_subs(BIDS_dir="BIDS_dir", index_dir=None, ignore=None, reindex=False):
     """
     Gets list of subjects in a BIDS directory, by default it looks in "data" folder in your CWD
     Input str of path to BIDS dir otherwise
+    Inputs:
+        - index_dir (str): where the layout index is kept, defaults to a folder of `~/.cache/pipetography/layout_index`.
+          If it isn't writable the dataset is crawled again and the layout is kept in memory
+        - ignore (list): top level folders to skip, defaults to code, derivatives, sourcedata, stimuli and models
+        - reindex (bool): discard the existing index and crawl the whole dataset again
+    Only directories whose mtime changed are listed again, but any change means the pybids database
+    is rebuilt in full the first time the returned layout is used.
     """
-    print(
-        "Creating layout of data directory, might take a while if there are a lot of subjects"
-    )
-    layout = BIDSLayout(BIDS_dir)
-    sub_list = layout.get_subjects()
-    ses_list = layout.get_sessions()
+    ignore = list(_LAYOUT_IGNORE if ignore is None else ignore)
+    if index_dir is None:
+        index_dir = _default_index_dir(BIDS_dir)
+    if not _writable_dir(index_dir):
+        index_dir = None
+    index_file = index_dir and os.path.join(index_dir, 'directories.json')
+
+    old_dirs = {}
+    if index_file and not reindex and os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get('version') == _INDEX_VERSION and index.get('ignore') == ignore:
+            old_dirs = {rel: tuple(entry) for rel, entry in index['dirs'].items()}
+
+    new_dirs = {}
+    changed = _refresh_dir_index(BIDS_dir, '', old_dirs, new_dirs, ignore)
+    changed |= set(old_dirs) != set(new_dirs)
+    database_path = None
+    if index_dir:
+        index = json.dumps({'version': _INDEX_VERSION, 'ignore': ignore, 'dirs': new_dirs}, sort_keys=True)
+        # pybids has no partial update, a changed dataset gets a new database the next time the layout is used
+        database_name = 'pybids-' + hashlib.sha1(index.encode()).hexdigest()[:16]
+        database_path = os.path.join(index_dir, database_name)
+        if changed:
+            with tempfile.NamedTemporaryFile('w', dir=index_dir, suffix='.tmp', delete=False) as f:
+                f.write(index)
+            os.replace(f.name, index_file)
+            for name in os.listdir(index_dir):
+                if name.startswith('pybids-') and name != database_name:
+                    shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+    sub_list = sorted(name[4:] for name in new_dirs[''][1] if name.startswith('sub-'))
+    ses_list = sorted({
+        name[4:]
+        for sub in sub_list
+        for name in new_dirs['sub-' + sub][1]
+        if name.startswith('ses-')
+    })
+    layout = _LazyLayout(BIDS_dir, database_path, ignore)
     return sub_list, ses_list, layout
 
+# Internal Cell
+from concurrent.futures import ThreadPoolExecutor
+
+def _list_sessions(sub_dir):
+    """session labels of the `ses-*` folders in a subject folder"""
+    try:
+        with os.scandir(sub_dir) as entries:
+            return sorted(
+                entry.name[4:] for entry in entries
+                if entry.name.startswith('ses-') and entry.is_dir()
+            )
+    except FileNotFoundError:
+        return []
+
 # Cell
+def discover_sessions(BIDS_dir, sub_list, ses_list=None, exclude_list=(), n_jobs=8):
+    """
+    Find the (subject, session) combinations that exist in a BIDS directory.
+    Inputs:
+        - sub_list (list): subjects to look for
+        - ses_list (list): only keep these sessions, all sessions are kept if None
+        - exclude_list (list of tuples): [('subject', 'session')] combinations to skip
+        - n_jobs (int): number of threads listing subject folders
+    Returns a sorted list of (subject, session) tuples
+    """
+    subjects = sorted(set(sub_list))
+    keep_ses = None if ses_list is None else set(ses_list)
+    skip = set(tuple(combo) for combo in exclude_list)
+    sub_dirs = [os.path.join(BIDS_dir, 'sub-' + sub) for sub in subjects]
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        sessions = pool.map(_list_sessions, sub_dirs)
+    return [
+        (sub, ses)
+        for sub, sub_sessions in zip(subjects, sessions)
+        for ses in sub_sessions
+        if (keep_ses is None or ses in keep_ses) and (sub, ses) not in skip
+    ]
+
 def filter_workflow(BIDS_dir, sub_list, ses_list, exclude_list):
-    all_sub_ses_combos = set(product(sub_list, ses_list))
-    missing_list = []
-    for combo in all_sub_ses_combos:
-        sub_ses_dir = os.path.join(BIDS_dir, 'sub-'+combo[0], 'ses-'+combo[1])
-        if not os.path.exists(sub_ses_dir):
-            missing_list.append(combo)
-
-    filtered_sub_ses_list = list(all_sub_ses_combos - set(missing_list) - set(exclude_list))
-    sub_iter = [tup[0] for tup in filtered_sub_ses_list]
-    ses_iter = [tup[1] for tup in filtered_sub_ses_list]
+    """
+    Split the existing (subject, session) combinations into the two lists used as synchronized iterables
+    """
+    sub_ses = discover_sessions(BIDS_dir, sub_list, ses_list, exclude_list)
+    sub_iter = [sub for sub, _ in sub_ses]
+    ses_iter = [ses for _, ses in sub_ses]
     return sub_iter, ses_iter
 
 # Cell
@@ -71,26 +217,226 @@ def get_sub_gradfiles(sub_dwi, ext = 'nii.gz'):
     else:
         sys.exit('Gradient files missing for {}'.format(sub_dwi))
 
+# Internal Cell
+_SIDECAR_CACHE = {}
+
+def _bids_entities(fname):
+    """split a BIDS file name into a dict of key-value entities and its suffix"""
+    parts = fname.split('.')[0].split('_')
+    entities = dict(part.split('-', 1) for part in parts[:-1] if '-' in part)
+    return entities, parts[-1]
+
+def _load_sidecar(json_file):
+    """parse a JSON sidecar, reusing the cached copy until its mtime changes"""
+    mtime = os.stat(json_file).st_mtime_ns
+    cached = _SIDECAR_CACHE.get(json_file)
+    if cached is None or cached[0] != mtime:
+        with open(json_file) as f:
+            cached = (mtime, json.load(f))
+        _SIDECAR_CACHE[json_file] = cached
+    return cached[1]
+
+# Cell
+def get_sidecar_chain(path, bids_dir):
+    """
+    List the JSON sidecars that apply to `path` under the BIDS inheritance principle,
+    ordered from least specific (dataset root) to most specific (the file's own sidecar)
+    """
+    path = os.path.abspath(path)
+    root = os.path.abspath(bids_dir)
+    entities, suffix = _bids_entities(os.path.basename(path))
+    rel_dir = os.path.relpath(os.path.dirname(path), root)
+    if rel_dir.startswith(os.pardir):
+        # file lives outside of the dataset, only its own directory applies
+        levels = [os.path.dirname(path)]
+    else:
+        levels = [root]
+        if rel_dir != os.curdir:
+            for part in rel_dir.split(os.sep):
+                levels.append(os.path.join(levels[-1], part))
+    chain = []
+    for level in levels:
+        candidates = []
+        with os.scandir(level) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+                json_entities, json_suffix = _bids_entities(entry.name)
+                if json_suffix == suffix and json_entities.items() <= entities.items():
+                    candidates.append((len(json_entities), entry.path))
+        chain.extend(json_file for _, json_file in sorted(candidates))
+    return chain
+
+def get_sidecar_metadata(path, bids_dir):
+    """
+    Resolve the BIDS metadata of a single file by merging its sidecar chain, without building a `BIDSLayout`
+    """
+    metadata = {}
+    for json_file in get_sidecar_chain(path, bids_dir):
+        metadata.update(_load_sidecar(json_file))
+    return metadata
+
 # Cell
 
 def BIDS_metadata(path, bids_dir):
     PEDIR = None
-    from bids.layout import BIDSLayout
-    bids_layout =  BIDSLayout(bids_dir)
+    # absolute import, nipype Function nodes run this function's source outside the package
+    import pipetography.core as ppt
+    metadata = ppt.get_sidecar_metadata(path, bids_dir)
     # total read out itme
     try:
-        TRT = bids_layout.get_metadata(path)['TotalReadoutTime']
-    except:
+        TRT = metadata['TotalReadoutTime']
+    except KeyError:
         print('No totalreadouttime in BIDS DWI JSON file, setting to default 0.1')
         TRT = 0.1
     # phase encoding direction
     try:
-        PEDIR = bids_layout.get_metadata(path)['PhaseEncodingDirection']
+        PEDIR = metadata['PhaseEncodingDirection']
     except KeyError:
         print('No phase encoding direction in JSON! Please add to all DWI JSON')
 
     return TRT, PEDIR
 
+# Internal Cell
+import re, errno
+from concurrent.futures import ThreadPoolExecutor
+from nipype.interfaces.base import isdefined
+from nipype.interfaces.io import DataSink, DataSinkInputSpec
+from nipype.utils.filemanip import get_related_files
+from .mif import _read_header
+
+_ITERABLE_FOLDER = re.compile(
+    r"(?P<stage>[^/]+)/_session_id_(?P<ses>[^/]+?)_subject_id_(?P<sub>[^/]+)"
+)
+_FICLONE = 0x40049409  # linux ioctl cloning a file's extents
+
+def _reflink(src, dst):
+    """copy-on-write clone `src` to `dst`, returns False if the filesystem can't"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dst)
+    return False
+
+def _transfer_file(src, dst, transfer):
+    """
+    Place `src` at `dst` with the requested transfer, falling back to a copy.
+    Returns the transfer that was actually used.
+    """
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return transfer
+        os.remove(dst)
+    if transfer == 'move':
+        try:
+            os.replace(src, dst)
+            return transfer
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+    elif transfer == 'hardlink':
+        try:
+            os.link(src, dst)
+            return transfer
+        except OSError:
+            pass
+    elif transfer == 'reflink' and _reflink(src, dst):
+        return transfer
+    tmp_dst = dst + '.partial'
+    shutil.copy2(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+    return 'copy'
+
+def _related_transfers(src, dst):
+    "(source, destination) of the files going with `src`: nipype's related files and the data files of a .mih header"
+    pairs = [
+        (related, new)
+        for related, new in zip(get_related_files(src, include_this_file=False), get_related_files(dst, include_this_file=False))
+        if related != src and os.path.isfile(related)
+    ]
+    if src.endswith('.mih'):
+        # the header names its data files relative to itself, they keep their names
+        header, _ = _read_header(src)
+        for entry in header.get('file', []):
+            data_file = entry.partition(' ')[0]
+            if data_file != '.':
+                pairs.append((os.path.join(os.path.dirname(src), data_file), os.path.join(os.path.dirname(dst), data_file)))
+    return pairs
+
+class BIDSDataSinkInputSpec(DataSinkInputSpec):
+    transfer = traits.Enum(
+        'copy', 'hardlink', 'reflink', 'move',
+        usedefault=True,
+        desc="how outputs are placed in the sink, falls back to copy when not possible",
+    )
+    n_threads = traits.Int(
+        4, usedefault=True, desc="number of threads copying outputs"
+    )
+
+# Cell
+class BIDSDataSink(DataSink):
+    """
+    DataSink mapping `<stage>/_session_id_<ses>_subject_id_<sub>` output folders to `sub-<sub>/ses-<ses>/<stage>`,
+    that can hardlink, reflink or move outputs instead of copying them.
+    """
+    input_spec = BIDSDataSinkInputSpec
+
+    def _substitute(self, pathstr):
+        pathstr = _ITERABLE_FOLDER.sub(r"sub-\g<sub>/ses-\g<ses>/\g<stage>", pathstr, count=1)
+        return super()._substitute(pathstr)
+
+    def _list_outputs(self):
+        s3_flag, _ = self._check_s3_base_dir()
+        if s3_flag:
+            return super()._list_outputs()
+        outputs = self.output_spec().get()
+        outdir = self.inputs.base_directory if isdefined(self.inputs.base_directory) else '.'
+        if isdefined(self.inputs.container):
+            outdir = os.path.join(outdir, self.inputs.container)
+        outdir = os.path.abspath(outdir)
+
+        out_files = []
+        transfers = []
+        for key, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            tempoutdir = os.path.join(outdir, *[d for d in key.split('.') if d[0] != '@'])
+            files = files if isinstance(files, list) else [files]
+            if files and isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+            for src in files:
+                src = os.path.abspath(src)
+                if not os.path.isfile(src):
+                    src = os.path.join(src, '')
+                dst = self._substitute(os.path.join(tempoutdir, self._get_dst(src)))
+                out_files.append(dst)
+                if os.path.isfile(src):
+                    transfers.append((src, dst))
+                    transfers.extend(_related_transfers(src, dst))
+                    continue
+                # directories are transferred file by file
+                src = src.rstrip(os.path.sep)
+                if os.path.exists(dst) and self.inputs.remove_dest_dir:
+                    shutil.rmtree(dst)
+                for root, _, fnames in os.walk(src):
+                    for fname in fnames:
+                        src_file = os.path.join(root, fname)
+                        transfers.append((src_file, os.path.join(dst, os.path.relpath(src_file, src))))
+
+        for dst_dir in {os.path.dirname(dst) for _, dst in transfers}:
+            os.makedirs(dst_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, self.inputs.n_threads)) as pool:
+            list(pool.map(lambda pair: _transfer_file(*pair, self.inputs.transfer), transfers))
+        outputs['out_file'] = out_files
+        return outputs
+
 # Internal Cell
 class PipetographyBaseInputSpec(CommandLineInputSpec):
     export_grad = traits.Str(
@@ -1057,9 +1403,13 @@ class tckSIFT2InputSpec(CommandLineInputSpec):
         argstr="-force",
         desc="overwrite existing output file"
     )
+    out_npy = traits.Bool(
+        desc="also save the weights as float32 in a .npy file next to out_file, read by the native connectome nodes instead of the text"
+    )
 
 class tckSIFT2OutputSpec(TraitedSpec):
     out_file=File(argstr="%s", desc="output text file containing the weighting factor for each streamline")
+    out_npy=File(desc="weighting factor for each streamline as a float32 .npy file")
 
 
 class tckSIFT2(CommandLine):
@@ -1072,9 +1422,22 @@ class tckSIFT2(CommandLine):
     input_spec=tckSIFT2InputSpec
     output_spec=tckSIFT2OutputSpec
 
+    def _npy_file(self):
+        return os.path.splitext(os.path.abspath(self.inputs.out_file))[0] + ".npy"
+
+    def _run_interface(self, runtime):
+        runtime = super()._run_interface(runtime)
+        if self.inputs.out_npy:
+            # the text is parsed once here, downstream nodes memory-map the .npy
+            weights = np.loadtxt(self.inputs.out_file, comments="#", ndmin=1).ravel()
+            np.save(self._npy_file(), weights.astype(np.float32))
+        return runtime
+
     def _list_outputs(self):
         outputs=self.output_spec().get()
         outputs["out_file"] = os.path.abspath(self.inputs.out_file)
+        if self.inputs.out_npy:
+            outputs["out_npy"] = self._npy_file()
         return outputs
 
 # Internal Cell
@@ -0,0 +1,279 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 05_dwi.ipynb (unless otherwise specified).
+
+__all__ = ['UpdateGradientInputSpec', 'UpdateGradientOutputSpec', 'UpdateGradient', 'MeanB0InputSpec',
+           'MeanB0OutputSpec', 'MeanB0', 'DTIMetricsInputSpec', 'DTIMetricsOutputSpec', 'DTIMetrics',
+           'RicianCorrectionInputSpec', 'RicianCorrectionOutputSpec', 'RicianCorrection']
+
+# Internal Cell
+import os
+import numpy as np
+import nibabel as nb
+from concurrent.futures import ThreadPoolExecutor
+
+from nipype.interfaces.base import (
+    BaseInterface,
+    BaseInterfaceInputSpec,
+    File,
+    TraitedSpec,
+    isdefined,
+    traits,
+)
+from .mif import create_mif, load_mif, save_mif, set_dw_scheme
+
+# Cell
+class UpdateGradientInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input .mif/.mih image")
+    grad_file = File(exists=True, mandatory=True, desc="MRtrix format gradient file")
+    out_file = File("dwi.mih", usedefault=True, desc="output .mih header")
+
+class UpdateGradientOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="image header with the new gradient table")
+
+class UpdateGradient(BaseInterface):
+    """
+    Replace the gradient table of a DWI, writing a .mih header with the input's data hardlinked next to it
+    """
+    input_spec = UpdateGradientInputSpec
+    output_spec = UpdateGradientOutputSpec
+
+    def _run_interface(self, runtime):
+        set_dw_scheme(self.inputs.in_file, self.inputs.grad_file, os.path.abspath(self.inputs.out_file), link_data=True)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["out_file"] = os.path.abspath(self.inputs.out_file)
+        return outputs
+
+# Internal Cell
+def _slab_size(shape, dtype, max_mb=256):
+    "number of slices along the 3rd axis that fit within `max_mb`"
+    slice_bytes = np.prod(shape[:2]) * np.prod(shape[3:]) * np.dtype(dtype).itemsize
+    return int(max(1, min(shape[2], max_mb * 1024 ** 2 // max(slice_bytes, 1))))
+
+def _save_nifti(data, affine, fname):
+    nb.Nifti1Image(data.astype(np.float32), affine).to_filename(fname)
+    return os.path.abspath(fname)
+
+# Cell
+class MeanB0InputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input .mif/.mih DWI with its gradient table")
+    mask_file = File(exists=True, desc="brain mask .mif/.mih image")
+    bzero_threshold = traits.Float(10.0, usedefault=True, desc="b-values at or below this are b=0 volumes")
+    out_file = File("b0_dwi.nii.gz", usedefault=True, desc="mean b0 NIfTI image")
+    out_masked = File("b0_dwi_brain.nii.gz", usedefault=True, desc="brain-masked mean b0 NIfTI image")
+
+class MeanB0OutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="mean b0 NIfTI image")
+    out_masked = File(desc="brain-masked mean b0 NIfTI image")
+
+class MeanB0(BaseInterface):
+    """
+    Average the b=0 volumes of a DWI and write the mean and brain-masked mean as NIfTI images, in one pass over the data
+    """
+    input_spec = MeanB0InputSpec
+    output_spec = MeanB0OutputSpec
+
+    def _run_interface(self, runtime):
+        img = load_mif(self.inputs.in_file)
+        if img.dw_scheme is None:
+            raise ValueError("{} has no gradient table".format(self.inputs.in_file))
+        b0 = np.flatnonzero(img.dw_scheme[:, 3] <= self.inputs.bzero_threshold)
+        if b0.size == 0:
+            raise ValueError("{} has no b=0 volumes".format(self.inputs.in_file))
+        mean = np.empty(img.shape[:3], dtype=np.float64)
+        slab = _slab_size(img.shape, img.dtype)
+        for z in range(0, img.shape[2], slab):
+            mean[:, :, z : z + slab] = img.data[:, :, z : z + slab][..., b0].mean(axis=-1)
+        offset, scale = img.scaling
+        mean = mean * scale + offset
+        _save_nifti(mean, img.affine, self.inputs.out_file)
+        if isdefined(self.inputs.mask_file):
+            mask = load_mif(self.inputs.mask_file).data.reshape(img.shape[:3]) > 0.5
+            _save_nifti(mean * mask, img.affine, self.inputs.out_masked)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["out_file"] = os.path.abspath(self.inputs.out_file)
+        if isdefined(self.inputs.mask_file):
+            outputs["out_masked"] = os.path.abspath(self.inputs.out_masked)
+        return outputs
+
+# Internal Cell
+def _tensor_design(dw_scheme, bzero_threshold=10.0):
+    "log-linear design matrix of the tensor model, columns Dxx Dyy Dzz Dxy Dxz Dyz log(S0)"
+    bvec = np.array(dw_scheme[:, :3], dtype=float)
+    bval = np.array(dw_scheme[:, 3], dtype=float)
+    norm = np.linalg.norm(bvec, axis=1)
+    bvec[norm > 0] /= norm[norm > 0, None]
+    bval[bval <= bzero_threshold] = 0
+    x, y, z = bvec.T
+    return np.column_stack(
+        [-bval * x * x, -bval * y * y, -bval * z * z,
+         -2 * bval * x * y, -2 * bval * x * z, -2 * bval * y * z,
+         np.ones_like(bval)]
+    )
+
+def _fit_tensor(signal, design, design_pinv, n_iter=2):
+    "batched (iterated) WLS tensor fit of a voxels x volumes signal array"
+    log_signal = np.log(np.maximum(signal, 1e-6))
+    params = log_signal @ design_pinv.T
+    for _ in range(n_iter):
+        weights = np.exp(2 * np.clip(params @ design.T, -50, 50))
+        weights /= weights.max(axis=1, keepdims=True)
+        lhs = np.einsum("nk,vn,nl->vkl", design, weights, design)
+        rhs = np.einsum("nk,vn->vk", design, weights * log_signal)
+        try:
+            params = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            break
+    return params
+
+def _tensor_eigenvalues(params):
+    "eigenvalues of the fitted tensors, in ascending order"
+    dxx, dyy, dzz, dxy, dxz, dyz = params[:, :6].T
+    tensors = np.stack(
+        [np.stack([dxx, dxy, dxz], -1), np.stack([dxy, dyy, dyz], -1), np.stack([dxz, dyz, dzz], -1)], -2
+    )
+    return np.linalg.eigvalsh(tensors)
+
+def _tensor_metrics(evals):
+    "FA, MD, AD and RD from tensor eigenvalues"
+    md = evals.mean(axis=1)
+    norm = np.sqrt((evals ** 2).sum(axis=1))
+    fa = np.sqrt(1.5 * ((evals - md[:, None]) ** 2).sum(axis=1)) / np.where(norm > 0, norm, 1)
+    return {"fa": np.clip(fa, 0, 1), "md": md, "ad": evals[:, 2], "rd": evals[:, :2].mean(axis=1)}
+
+# Cell
+class DTIMetricsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input .mif/.mih DWI with its gradient table")
+    mask_file = File(exists=True, desc="only fit the tensor within this mask")
+    bzero_threshold = traits.Float(10.0, usedefault=True, desc="b-values at or below this are b=0 volumes")
+    n_iter = traits.Int(2, usedefault=True, desc="number of weighted least squares iterations")
+    out_fa = File("fa.mif", usedefault=True, desc="fractional anisotropy image")
+    out_md = File(desc="mean diffusivity image")
+    out_ad = File(desc="axial diffusivity image")
+    out_rd = File(desc="radial diffusivity image")
+    max_mem_mb = traits.Int(1024, usedefault=True, nohash=True, desc="working memory ceiling in MB")
+    n_threads = traits.Int(
+        0, usedefault=True, nohash=True, desc="number of slabs fitted in parallel, 0 uses all CPUs"
+    )
+
+class DTIMetricsOutputSpec(TraitedSpec):
+    out_fa = File(exists=True, desc="fractional anisotropy image")
+    out_md = File(desc="mean diffusivity image")
+    out_ad = File(desc="axial diffusivity image")
+    out_rd = File(desc="radial diffusivity image")
+
+class DTIMetrics(BaseInterface):
+    """
+    Fit the diffusion tensor with batched weighted least squares and write its FA, MD, AD and RD maps in one pass
+    """
+    input_spec = DTIMetricsInputSpec
+    output_spec = DTIMetricsOutputSpec
+
+    def _metric_files(self):
+        metrics = {"fa": self.inputs.out_fa}
+        for metric in ("md", "ad", "rd"):
+            fname = getattr(self.inputs, "out_" + metric)
+            if isdefined(fname):
+                metrics[metric] = fname
+        return metrics
+
+    def _run_interface(self, runtime):
+        img = load_mif(self.inputs.in_file)
+        if img.dw_scheme is None:
+            raise ValueError("{} has no gradient table".format(self.inputs.in_file))
+        design = _tensor_design(img.dw_scheme, self.inputs.bzero_threshold)
+        design_pinv = np.linalg.pinv(design)
+        mask = None
+        if isdefined(self.inputs.mask_file):
+            mask = load_mif(self.inputs.mask_file).data.reshape(img.shape[:3])
+        outputs = {
+            metric: create_mif(fname, img.shape[:3], np.float32, vox=img.vox[:3], transform=img.transform)
+            for metric, fname in self._metric_files().items()
+        }
+        offset, scale = img.scaling
+        n_threads = self.inputs.n_threads or os.cpu_count() or 1
+        # signal, its log, the weights and their products take ~8 float64 copies per voxel
+        slab = _slab_size(img.shape, np.float64, max(1, self.inputs.max_mem_mb // (8 * n_threads)))
+
+        def fit_slab(z):
+            signal = np.asarray(img.data[:, :, z : z + slab], dtype=np.float64) * scale + offset
+            voxels = signal.max(axis=-1) > 0
+            if mask is not None:
+                voxels &= mask[:, :, z : z + slab] > 0.5
+            if not voxels.any():
+                return
+            params = _fit_tensor(signal[voxels], design, design_pinv, self.inputs.n_iter)
+            for metric, values in _tensor_metrics(_tensor_eigenvalues(params)).items():
+                if metric in outputs:
+                    outputs[metric].data[:, :, z : z + slab][voxels] = values
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(fit_slab, range(0, img.shape[2], slab)))
+        for out in outputs.values():
+            out.data.base.flush()
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        for metric, fname in self._metric_files().items():
+            outputs["out_" + metric] = os.path.abspath(fname)
+        return outputs
+
+# Cell
+class RicianCorrectionInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input .mif/.mih DWI")
+    noise_file = File(exists=True, mandatory=True, desc="noise level map from dwidenoise")
+    grad_file = File(exists=True, desc="MRtrix format gradient file embedded in the output")
+    out_file = File("rician_corrected_dwi.mif", usedefault=True, desc="output DWI")
+    max_mem_mb = traits.Int(1024, usedefault=True, nohash=True, desc="working memory ceiling in MB")
+    n_threads = traits.Int(
+        0, usedefault=True, nohash=True, desc="number of slabs corrected in parallel, 0 uses all CPUs"
+    )
+
+class RicianCorrectionOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Rician bias corrected DWI")
+
+class RicianCorrection(BaseInterface):
+    """
+    Remove the Rician noise floor of a DWI with a noise level map, in a single pass over the data
+    """
+    input_spec = RicianCorrectionInputSpec
+    output_spec = RicianCorrectionOutputSpec
+
+    def _run_interface(self, runtime):
+        img = load_mif(self.inputs.in_file)
+        noise = load_mif(self.inputs.noise_file).data.reshape(img.shape[:3])
+        header = {k: v for k, v in img.header.items() if k != "scaling"}
+        dw_scheme = None
+        if isdefined(self.inputs.grad_file):
+            dw_scheme = np.loadtxt(self.inputs.grad_file, comments="#", ndmin=2)
+        out = create_mif(
+            self.inputs.out_file, img.shape, np.float32, vox=img.vox, layout=img.layout,
+            dw_scheme=dw_scheme, header=header,
+        )
+        offset, scale = img.scaling
+        n_threads = self.inputs.n_threads or os.cpu_count() or 1
+        slab = _slab_size(img.shape, np.float64, max(1, self.inputs.max_mem_mb // (3 * n_threads)))
+
+        def correct_slab(z):
+            signal = np.asarray(img.data[:, :, z : z + slab], dtype=np.float64) * scale + offset
+            sigma = np.asarray(noise[:, :, z : z + slab], dtype=np.float64)
+            sigma[~np.isfinite(sigma)] = 0
+            with np.errstate(invalid="ignore", over="ignore"):
+                corrected = np.sqrt(np.abs(signal ** 2 - sigma[..., None] ** 2))
+            corrected[~np.isfinite(corrected)] = 0
+            out.data[:, :, z : z + slab] = corrected
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(correct_slab, range(0, img.shape[2], slab)))
+        out.data.base.flush()
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["out_file"] = os.path.abspath(self.inputs.out_file)
+        return outputs
\ No newline at end of file
@@ -0,0 +1,415 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 09_execution.ipynb (unless otherwise specified).
+
+__all__ = ['run_batched', 'RESOURCE_PROFILES', 'DEFAULT_PROFILE', 'apply_resource_profiles', 'NODE_COSTS',
+           'DEFAULT_COST', 'CLEANUP_KEEP', 'CLEANUP_MIN_SIZE', 'CriticalPathPlugin']
+
+# Internal Cell
+import os
+import re
+import json
+import time
+import fnmatch
+import numpy as np
+import multiprocessing
+from multiprocessing.connection import wait
+from nipype.pipeline.plugins import MultiProcPlugin
+from nipype.utils.profiler import get_system_total_memory_gb
+
+# Internal Cell
+def _batches(sessions, batch_size):
+    return [sessions[i : i + batch_size] for i in range(0, len(sessions), batch_size)]
+
+def _set_sessions(subject_source, sessions):
+    subject_source.iterables = [
+        ("subject_id", [sub for sub, _ in sessions]),
+        ("session_id", [ses for _, ses in sessions]),
+    ]
+
+def _batch_share(n_procs, memory_gb, batches_in_flight):
+    "CPUs and memory (GB) of each of `batches_in_flight` batches sharing `n_procs` and `memory_gb`, None when not given"
+    share = max(1, batches_in_flight)
+    return n_procs and max(1, n_procs // share), memory_gb and memory_gb / share
+
+def _run_batch(workflow, subject_source, sessions, plugin, plugin_args):
+    _set_sessions(subject_source, sessions)
+    if isinstance(plugin, str):
+        workflow.run(plugin, plugin_args=plugin_args)
+    else:
+        # plugin instances can't be reused once they've run, every batch gets its own
+        workflow.run(plugin(plugin_args=plugin_args))
+
+# Cell
+def run_batched(workflow, subject_source, sessions, batch_size=50, batches_in_flight=1, plugin="Linear", plugin_args=None):
+    """
+    Run a workflow over its sessions a batch at a time, expanding only the graph of the sessions in a batch
+    Inputs:
+        - workflow (Workflow): connected workflow, iterating over sessions through `subject_source`
+        - subject_source (Node): node with synchronized `subject_id` and `session_id` iterables
+        - sessions (list): (subject, session) tuples to run
+        - batch_size (int): number of sessions per batch
+        - batches_in_flight (int): number of batches running at once, in separate processes when above 1
+        - plugin (str or class): nipype execution plugin of each batch, by name (e.g. "MultiProc") or class (e.g. `CriticalPathPlugin`)
+        - plugin_args (dict): plugin arguments, `n_procs` and `memory_gb` are shared by the batches in flight
+    """
+    plugin_args = dict(plugin_args or {})
+    stop_on_crash = str(workflow.config["execution"].get("stop_on_first_crash", False)).lower() == "true"
+    pending = _batches(list(sessions), batch_size)
+    iterables = subject_source.iterables
+    failed = []
+    try:
+        if batches_in_flight <= 1:
+            for batch in pending:
+                try:
+                    _run_batch(workflow, subject_source, batch, plugin, plugin_args)
+                except RuntimeError:
+                    if stop_on_crash:
+                        raise
+                    failed.append(batch)
+        else:
+            n_procs, memory_gb = _batch_share(plugin_args.get("n_procs"), plugin_args.get("memory_gb"), batches_in_flight)
+            plugin_args.update({key: value for key, value in (("n_procs", n_procs), ("memory_gb", memory_gb)) if value})
+            context = multiprocessing.get_context("fork")
+            running = {}
+            while (pending and not (failed and stop_on_crash)) or running:
+                while pending and len(running) < batches_in_flight and not (failed and stop_on_crash):
+                    batch = pending.pop(0)
+                    proc = context.Process(target=_run_batch, args=(workflow, subject_source, batch, plugin, plugin_args))
+                    proc.start()
+                    running[proc.sentinel] = (proc, batch)
+                for sentinel in wait(list(running)):
+                    proc, batch = running.pop(sentinel)
+                    proc.join()
+                    if proc.exitcode != 0:
+                        failed.append(batch)
+    finally:
+        subject_source.iterables = iterables
+    if failed:
+        raise RuntimeError(
+            "Workflow did not execute cleanly for sessions {}".format(
+                ", ".join("sub-{}/ses-{}".format(sub, ses) for batch in failed for sub, ses in batch)
+            )
+        )
+
+# Cell
+# node name: (threads, mem_gb, io_weight)
+RESOURCE_PROFILES = {
+    # PreProcNodes
+    "Convert2Mif": (2, 2.0, 0.5),
+    "Convert2MifForward": (2, 2.0, 0.5),
+    "Convert2MifReverse": (2, 2.0, 0.5),
+    "concat_dwi": (2, 2.0, 0.5),
+    "Dwi2Mask": (2, 1.0, 0.25),
+    "GradientCheck": (2, 2.0, 0.5),
+    "ConvertDWI2Mif": (2, 2.0, 0.5),
+    "Denoise": (8, 4.0, 0.25),
+    "RingingRemoval": (8, 4.0, 0.25),
+    "DWIFSLPreproc": (8, 8.0, 0.25),
+    "RecreateMask": (4, 1.0, 0.25),
+    "BiasCorrection": (4, 4.0, 0.25),
+    "RicianCorrection": (8, 2.0, 0.25),
+    "tensor2metrics": (8, 2.0, 0.25),
+    "mrthreshold": (2, 1.0, 0.25),
+    "DWINormalise": (4, 4.0, 0.25),
+    "MeanB0Volume": (1, 1.0, 0.25),
+    "DWI2Mask": (2, 1.0, 0.25),
+    "MNIB0MeanVolume": (1, 1.0, 0.25),
+    "MNIB0BrainMask": (2, 1.0, 0.25),
+    "MNI_Outputs": (4, 4.0, 0.5),
+    "DataSink": (4, 0.5, 1.0),
+    "DWIReorient": (1, 1.0, 0.5),
+    "DWIReorientForward": (1, 1.0, 0.5),
+    "DWIReorientReverse": (1, 1.0, 0.5),
+    "concat_grad": (1, 0.25, 0.1),
+    "AlteredGradient": (1, 0.25, 0.1),
+    "ModifyGradient": (1, 0.25, 0.1),
+    "UpdateMif": (1, 0.25, 0.1),
+    "NewGradient": (1, 0.25, 0.1),
+    "dwi2mask": (2, 1.0, 0.25),
+    "MNIMask2Nifti": (2, 1.0, 0.5),
+    # ACPCNodes
+    "FLIRT": (1, 2.0, 0.1),
+    "ACPCApplyWarp": (1, 2.0, 0.25),
+    "FSLBet": (1, 1.0, 0.1),
+    "fsl_epireg": (1, 4.0, 0.1),
+    "MRTransform": (4, 4.0, 0.5),
+    "Regrid": (4, 4.0, 0.5),
+    "Mrtrix5TTGen": (4, 4.0, 0.1),
+    "5tt2gmwmi": (2, 2.0, 0.25),
+    "GMWMI": (2, 1.0, 0.25),
+    "GetWMMask": (2, 1.0, 0.25),
+    "T1Reorient": (1, 1.0, 0.5),
+    "ReduceFOV": (1, 1.0, 0.25),
+    "InverseTransformation": (1, 0.25, 0.1),
+    "ConcatTransform": (1, 0.25, 0.1),
+    "aff2rigid": (1, 0.25, 0.1),
+    "ConvertTransformation": (1, 0.25, 0.1),
+    # PostProcNodes
+    "LinearRegistration": (4, 2.0, 0.1),
+    "NonLinearRegistration": (8, 4.0, 0.1),
+    "TemplateRegistration": (8, 4.0, 0.1),
+    "WarpAtlas": (2, 1.0, 0.25),
+    "SDResponse": (4, 2.0, 0.25),
+    "dwiFOD": (8, 4.0, 0.25),
+    "tckgen": (1, 1.0, 0.1),
+    "MergeTracks": (1, 0.5, 1.0),
+    "tck_sink": (1, 0.2, 1.0),
+    "SIFT2": (8, 16.0, 0.5),
+    "TckSample": (4, 2.0, 0.5),
+    "SampleStreamlines": (1, 2.0, 0.5),
+    "WeightConnectome": (4, 2.0, 0.5),
+    "WeightDistance": (4, 2.0, 0.5),
+    "WeightFA": (4, 2.0, 0.5),
+    "StreamlineEndpoints": (1, 1.0, 1.0),
+    "ParcellationDistance": (1, 1.0, 0.1),
+    "ConnectomeMatrices": (1, 2.0, 0.25),
+    "datasink": (4, 0.5, 1.0),
+}
+DEFAULT_PROFILE = (1, 0.25, 0.1)
+
+# Internal Cell
+_THREAD_INPUTS = ("nthreads", "n_threads", "num_threads")
+_THREAD_ENVIRON = ("OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
+
+def _set_threads(node, threads):
+    node.n_procs = threads
+    inputs = node.inputs.traits()
+    for name in _THREAD_INPUTS:
+        if name in inputs:
+            setattr(node.inputs, name, threads)
+    if "environ" in inputs:
+        environ = {name: str(threads) for name in _THREAD_ENVIRON}
+        if "environ" in getattr(node, "iterfield", []):
+            # per-item environments of a MapNode, e.g. the random seed of each tractography shard
+            node.inputs.environ = [dict(item, **environ) for item in node.inputs.environ]
+        else:
+            node.inputs.environ = dict(node.inputs.environ, **environ)
+
+# Cell
+def apply_resource_profiles(workflow, n_procs=None, memory_gb=None, profiles=None):
+    """
+    Set the threads, memory and I/O weight of every node of a workflow from their resource profile
+    Inputs:
+        - workflow (Workflow): workflow whose nodes, in nested workflows too, are updated in place
+        - n_procs (int): number of CPUs shared by the nodes, threads of a node are capped to it. Defaults to all CPUs
+        - memory_gb (float): memory shared by the nodes, memory of a node is capped to it. Defaults to what `MultiProc` detects
+        - profiles (dict): {node name: (threads, mem_gb, io_weight)}, updates `RESOURCE_PROFILES`
+    """
+    n_procs = n_procs or os.cpu_count()
+    memory_gb = memory_gb or get_system_total_memory_gb() * 0.9
+    table = dict(RESOURCE_PROFILES, **(profiles or {}))
+    for node in workflow._get_all_nodes():
+        threads, mem_gb, io_weight = table.get(node.name, DEFAULT_PROFILE)
+        _set_threads(node, max(1, min(threads, n_procs)))
+        node._mem_gb = min(mem_gb, memory_gb)
+        node._io_weight = io_weight
+    return workflow
+
+# Cell
+# estimated run time (s) of each node, by name
+NODE_COSTS = {
+    "Denoise": 300,
+    "RingingRemoval": 180,
+    "DWIFSLPreproc": 3600,
+    "BiasCorrection": 600,
+    "RicianCorrection": 60,
+    "DWINormalise": 300,
+    "MNI_Outputs": 120,
+    "FLIRT": 120,
+    "fsl_epireg": 300,
+    "Mrtrix5TTGen": 900,
+    "LinearRegistration": 300,
+    "NonLinearRegistration": 1800,
+    "TemplateRegistration": 1800,
+    "SDResponse": 300,
+    "dwiFOD": 600,
+    "tckgen": 1800,
+    "SIFT2": 1200,
+    "TckSample": 300,
+    "WeightConnectome": 300,
+    "WeightDistance": 300,
+    "WeightFA": 300,
+}
+DEFAULT_COST = 10
+# node files kept by the cleanup
+CLEANUP_KEEP = ("*.pklz", "*.rst", "*.log", "command.txt")
+CLEANUP_MIN_SIZE = 2 ** 20
+
+# Internal Cell
+def _cost_name(node):
+    "node name, without the index of MapNode sub-nodes (`_tckgen3` is `tckgen`)"
+    match = re.fullmatch(r"_(.+?)\d+", node.name)
+    return match.group(1) if match else node.name
+
+def _session_key(node):
+    "iterable parameterization of the subject and session of an expanded node, None outside the sessions"
+    return next((param for param in node.parameterization if "_session_id_" in param or "_subject_id_" in param), None)
+
+def _forwards_files(node):
+    "utility nodes pass file names on to their downstream nodes"
+    return type(node.interface).__module__.startswith("nipype.interfaces.utility")
+
+def _consumers(graph, index):
+    "{jobid: jobids of the nodes using its outputs}, through the utility nodes"
+    found = {}
+    def consumers(node):
+        if node not in found:
+            found[node] = set()
+            for child in graph.successors(node):
+                found[node].add(index[child])
+                if _forwards_files(child):
+                    found[node] |= consumers(child)
+        return found[node]
+    return {index[node]: consumers(node) for node in graph.nodes() if graph.out_degree(node)}
+
+def _remove_outputs(outdir, min_size=CLEANUP_MIN_SIZE):
+    "delete the large files of a node directory, and its hash files so the node runs again if needed"
+    removed = []
+    for root, _, files in os.walk(outdir):
+        for fname in files:
+            path = os.path.join(root, fname)
+            if any(fnmatch.fnmatch(fname, pattern) for pattern in CLEANUP_KEEP) or os.path.islink(path):
+                continue
+            if os.path.getsize(path) >= min_size:
+                os.remove(path)
+                removed.append(path)
+    if removed:
+        for root, _, files in os.walk(outdir):
+            for fname in fnmatch.filter(files, "_0x*.json"):
+                os.remove(os.path.join(root, fname))
+    return removed
+
+def _load_history(history_file):
+    "{node name: [mean run time (s), number of runs]} from a history file"
+    if history_file and os.path.exists(history_file):
+        with open(history_file) as f:
+            return json.load(f)
+    return {}
+
+# Cell
+class CriticalPathPlugin(MultiProcPlugin):
+    """
+    MultiProc plugin starting the ready nodes with the longest estimated remaining path through the graph first
+    Plugin arguments, in addition to MultiProc's:
+        - costs (dict): {node name: estimated run time (s)}, updates `NODE_COSTS`
+        - history_file (str): JSON file of measured run times overriding the estimates, updated with this run's
+        - max_sessions (int): number of sessions in flight, new sessions start as running ones finish
+        - cleanup (bool): deletes the large outputs of a node once every node using them has finished
+        - cleanup_min_size (int): size in bytes of the smallest file deleted, defaults to `CLEANUP_MIN_SIZE`
+        - io_slots (float): sum of the I/O weights (see `apply_resource_profiles`) of the nodes running at once, unlimited by default
+    """
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self._history_file = self.plugin_args.get("history_file")
+        self._history = _load_history(self._history_file)
+        self._costs = dict(NODE_COSTS, **self.plugin_args.get("costs", {}))
+        self._costs.update({name: mean for name, (mean, _) in self._history.items()})
+        self._max_sessions = self.plugin_args.get("max_sessions")
+        self._cleanup = self.plugin_args.get("cleanup", False)
+        self._cleanup_min_size = self.plugin_args.get("cleanup_min_size", CLEANUP_MIN_SIZE)
+        self._io_slots = self.plugin_args.get("io_slots")
+        self._io = []
+        self._waiting = {}
+        self._producers = {}
+        self._rank = []
+        self._cost = []
+        self._session = []
+        self._started = {}
+
+    def _generate_dependency_list(self, graph):
+        super()._generate_dependency_list(graph)
+        rank = {}
+        for node in reversed(self.procs):
+            downstream = max((rank[child] for child in graph.successors(node)), default=0)
+            rank[node] = self._costs.get(_cost_name(node), DEFAULT_COST) + downstream
+        self._rank = [rank[node] for node in self.procs]
+        self._cost = [self._costs.get(_cost_name(node), DEFAULT_COST) for node in self.procs]
+        self._io = [getattr(node, "_io_weight", DEFAULT_PROFILE[2]) for node in self.procs]
+        keys, self._session = {}, []
+        for node in self.procs:
+            key = _session_key(node)
+            self._session.append(-1 if key is None else keys.setdefault(key, len(keys)))
+        if self._cleanup:
+            self._waiting = _consumers(graph, {node: jobid for jobid, node in enumerate(self.procs)})
+            self._producers = {}
+            for producer, consumers in self._waiting.items():
+                for consumer in consumers:
+                    self._producers.setdefault(consumer, []).append(producer)
+
+    def _submit_mapnode(self, jobid):
+        n_procs = len(self.procs)
+        submitted = super()._submit_mapnode(jobid)
+        # sub-nodes take the rank, cost and session of their MapNode
+        n_subnodes = len(self.procs) - n_procs
+        self._rank.extend([self._rank[jobid]] * n_subnodes)
+        self._cost.extend([self._cost[jobid]] * n_subnodes)
+        self._session.extend([self._session[jobid]] * n_subnodes)
+        # the MapNode's I/O is done by its sub-nodes
+        self._io.extend([self._io[jobid]] * n_subnodes)
+        self._io[jobid] = 0.0
+        return submitted
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        return self._limit_io(self._sort_by_path(jobids))
+
+    def _limit_io(self, jobs):
+        "jobs whose I/O weights fit in the slots left by the running nodes, a job always fits when nothing runs"
+        if not self._io_slots:
+            return jobs
+        io = np.array(self._io)
+        load = io[self.proc_done & self.proc_pending].sum()
+        fitting = []
+        for jobid in jobs:
+            if load > 0 and load + io[jobid] > self._io_slots:
+                continue
+            load += io[jobid]
+            fitting.append(jobid)
+        return fitting
+
+    def _sort_by_path(self, jobids):
+        if not self._max_sessions:
+            return sorted(jobids, key=lambda jobid: -self._rank[jobid])
+        session = np.array(self._session)
+        in_session = session >= 0
+        left = in_session & ~(self.proc_done & ~self.proc_pending)
+        n_sessions = session.max(initial=-1) + 1
+        remaining = np.bincount(session[left], weights=np.array(self._cost, dtype=float)[left], minlength=n_sessions)
+        started = np.bincount(session[in_session & self.proc_done], minlength=n_sessions) > 0
+        admitted = set(np.flatnonzero(started & (np.bincount(session[left], minlength=n_sessions) > 0)))
+        # nodes outside the sessions first, then by least work left in their session and longest path
+        order = sorted(
+            jobids, key=lambda jobid: (remaining[session[jobid]] if session[jobid] >= 0 else -1, -self._rank[jobid])
+        )
+        jobs = []
+        for jobid in order:
+            if session[jobid] >= 0 and session[jobid] not in admitted:
+                if len(admitted) >= self._max_sessions:
+                    continue
+                admitted.add(session[jobid])
+            jobs.append(jobid)
+        return jobs
+
+    def _submit_job(self, node, updatehash=False):
+        self._started[node.output_dir()] = time.time()
+        return super()._submit_job(node, updatehash=updatehash)
+
+    def _task_finished_cb(self, jobid, cached=False):
+        start = self._started.pop(self.procs[jobid].output_dir(), None)
+        if start is not None and not cached and jobid not in self.mapnodes:
+            mean, runs = self._history.get(_cost_name(self.procs[jobid]), (0.0, 0))
+            self._history[_cost_name(self.procs[jobid])] = [(mean * runs + time.time() - start) / (runs + 1), runs + 1]
+        super()._task_finished_cb(jobid, cached=cached)
+        if jobid in self.mapnodesubids:
+            return
+        for producer in self._producers.pop(jobid, []):
+            self._waiting[producer].discard(jobid)
+            if not self._waiting[producer]:
+                del self._waiting[producer]
+                _remove_outputs(self.procs[producer].output_dir(), self._cleanup_min_size)
+
+    def run(self, graph, config, updatehash=False):
+        try:
+            return super().run(graph, config, updatehash=updatehash)
+        finally:
+            if self._history_file:
+                with open(self._history_file, "w") as f:
+                    json.dump(self._history, f, indent=1, sort_keys=True)
\ No newline at end of file
@@ -0,0 +1,314 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 04_mif.ipynb (unless otherwise specified).
+
+__all__ = ['MIFImage', 'create_mif', 'load_mif', 'save_mif', 'set_dw_scheme']
+
+# Internal Cell
+import os
+import shutil
+import numpy as np
+
+# Internal Cell
+_DATATYPES = {
+    "Int8": "i1", "UInt8": "u1",
+    "Int16": "i2", "UInt16": "u2",
+    "Int32": "i4", "UInt32": "u4",
+    "Int64": "i8", "UInt64": "u8",
+    "Float32": "f4", "Float64": "f8",
+    "CFloat32": "c8", "CFloat64": "c16",
+    "Bit": "?",
+}
+_BYTEORDER = {"LE": "<", "BE": ">"}
+# header keys that hold numbers and are written once per row
+_MATRIX_KEYS = ("transform", "dw_scheme")
+
+def _np_dtype(datatype):
+    "numpy dtype of an MRtrix `datatype` string, e.g. `Float32LE`"
+    order = _BYTEORDER.get(datatype[-2:], "")
+    base = datatype[:-2] if order else datatype
+    if base not in _DATATYPES:
+        raise ValueError("Unsupported MRtrix datatype: {}".format(datatype))
+    return np.dtype(order + _DATATYPES[base])
+
+def _mrtrix_datatype(dtype):
+    "MRtrix `datatype` string of a numpy dtype"
+    dtype = np.dtype(dtype)
+    names = {np.dtype(v).str[1:]: k for k, v in _DATATYPES.items()}
+    if dtype.str[1:] not in names:
+        raise ValueError("Unsupported dtype for MRtrix images: {}".format(dtype))
+    name = names[dtype.str[1:]]
+    if dtype.itemsize == 1:
+        return name
+    return name + ("BE" if dtype.str[0] == ">" else "LE")
+
+def _nbytes(shape, dtype):
+    "size of the data block, Bit images pack 8 voxels per byte"
+    n_voxels = int(np.prod(shape))
+    if np.dtype(dtype) == bool:
+        return (n_voxels + 7) // 8
+    return n_voxels * np.dtype(dtype).itemsize
+
+def _parse_layout(layout):
+    "`-0,-1,+2,+3` to ranks [0, 1, 2, 3] and reversed axes [True, True, False, False]"
+    entries = [s.strip() for s in layout.split(",")]
+    return [int(s.lstrip("+-")) for s in entries], [s.startswith("-") for s in entries]
+
+def _read_header(fname, magic=b"mrtrix image"):
+    "Header of a .mif/.mih (or .tck) file as a dict of key: list of values, and the header length"
+    keyvals = {}
+    with open(fname, "rb") as f:
+        if f.readline().strip() != magic:
+            raise ValueError("{} is not an MRtrix {} file".format(fname, magic.decode().split()[-1]))
+        for line in f:
+            line = line.decode("utf-8").strip()
+            if line == "END":
+                break
+            key, sep, value = line.partition(":")
+            if sep:
+                keyvals.setdefault(key.strip(), []).append(value.strip())
+        else:
+            raise ValueError("{} has no END of header".format(fname))
+        return keyvals, f.tell()
+
+def _data_files(fname, header):
+    "absolute data file and offset of each `file:` entry, paths are relative to the header"
+    entries = []
+    for entry in header["file"]:
+        data_file, _, offset = entry.partition(" ")
+        if data_file == ".":
+            data_file = os.path.abspath(fname)
+        else:
+            data_file = os.path.join(os.path.dirname(os.path.abspath(fname)), data_file)
+        entries.append((data_file, int(offset or 0)))
+    return entries
+
+# Cell
+class MIFImage:
+    """
+    MRtrix image with its data block memory-mapped as a numpy array in image (x, y, z, volume) axis order.
+    Inputs:
+        - fname (str): .mif or .mih file
+        - mode (str): memory-map mode, 'r' read-only, 'r+' to modify the data in place, 'c' for copy-on-write
+    """
+    def __init__(self, fname, mode="r"):
+        self.fname = fname
+        self.header, _ = _read_header(fname)
+        self.shape = tuple(int(d) for d in self.header["dim"][0].split(","))
+        self.vox = tuple(float(v) for v in self.header["vox"][0].split(","))
+        self.layout = self.header["layout"][0]
+        self.dtype = _np_dtype(self.header["datatype"][0])
+        self.mode = mode
+        self.data = self._map(mode)
+
+    def _map(self, mode):
+        data_files = _data_files(self.fname, self.header)
+        if len(data_files) > 1:
+            raise ValueError("{}: images split across data files are not supported".format(self.fname))
+        data_file, offset = data_files[0]
+        ranks, flipped = _parse_layout(self.layout)
+        # storage axes ordered slowest to fastest, as numpy's C order expects
+        order = sorted(range(len(self.shape)), key=lambda ax: ranks[ax], reverse=True)
+        n_voxels = int(np.prod(self.shape))
+        if self.dtype == bool:
+            packed = np.memmap(data_file, dtype=np.uint8, mode="r", offset=offset, shape=(_nbytes(self.shape, bool),))
+            block = np.unpackbits(packed, count=n_voxels).view(bool)
+            block.flags.writeable = mode != "r"
+        else:
+            block = np.memmap(data_file, dtype=self.dtype, mode=mode, offset=offset, shape=(n_voxels,))
+        self._block, self._data_file, self._offset = block, data_file, offset
+        data = block.reshape([self.shape[ax] for ax in order]).transpose(np.argsort(order))
+        return data[tuple(slice(None, None, -1) if f else slice(None) for f in flipped)]
+
+    def flush(self):
+        "write the changes to the data to disk, when opened with mode 'r+'"
+        if self.mode != "r+":
+            return
+        if self.dtype == bool:
+            with open(self._data_file, "r+b") as f:
+                f.seek(self._offset)
+                f.write(np.packbits(self._block).tobytes())
+        else:
+            self._block.flush()
+
+    @property
+    def transform(self):
+        "4x4 scanner-space orientation and translation, without voxel sizes"
+        return _header_matrix(self.header, "transform", np.eye(4)[:3])
+
+    @property
+    def affine(self):
+        "4x4 voxel to scanner affine, as in NIfTI"
+        affine = self.transform.copy()
+        affine[:3, :3] = affine[:3, :3] * np.asarray(self.vox[:3])
+        return affine
+
+    @property
+    def dw_scheme(self):
+        "N x 4 gradient table (x, y, z, b) or None"
+        if "dw_scheme" not in self.header:
+            return None
+        return _header_matrix(self.header, "dw_scheme")
+
+    @property
+    def scaling(self):
+        "intensity (offset, multiplier) applied by MRtrix when reading the data"
+        if "scaling" not in self.header:
+            return 0.0, 1.0
+        return tuple(float(v) for v in self.header["scaling"][0].split(","))
+
+# Internal Cell
+def _header_matrix(header, key, default=None):
+    rows = header.get(key)
+    if rows is None:
+        return default
+    matrix = np.array([[float(v) for v in row.split(",")] for row in rows])
+    if key == "transform":
+        matrix = np.vstack([matrix, [0, 0, 0, 1]])
+    return matrix
+
+def _format_header(shape, vox, layout, dtype, keyvals):
+    lines = [
+        "mrtrix image",
+        "dim: " + ",".join(str(int(d)) for d in shape),
+        "vox: " + ",".join("{:.8g}".format(v) for v in vox),
+        "layout: " + layout,
+        "datatype: " + _mrtrix_datatype(dtype),
+    ]
+    for key, values in keyvals.items():
+        if key in ("dim", "vox", "layout", "datatype", "file"):
+            continue
+        if key in _MATRIX_KEYS and not isinstance(values[0], str):
+            values = [",".join("{:.10g}".format(v) for v in row) for row in values]
+        lines.extend("{}: {}".format(key, v) for v in values)
+    return "\n".join(lines) + "\n"
+
+# Cell
+def create_mif(fname, shape, dtype="float32", vox=None, transform=None, dw_scheme=None, layout=None, header=None):
+    """
+    Create a .mif or .mih image and return it memory-mapped for writing, so outputs are written straight to disk.
+    Inputs:
+        - fname (str): output .mif, or .mih with its data in a .dat file next to it
+        - shape (tuple): image dimensions
+        - dtype (str): numpy data type
+        - vox (tuple): voxel sizes, defaults to 1 along every axis
+        - transform (array): 3x4 or 4x4 scanner orientation and translation, without voxel sizes
+        - dw_scheme (array): N x 4 gradient table
+        - layout (str): MRtrix layout, defaults to the first axis varying fastest
+        - header (dict): other header keys, e.g. `MIFImage.header` of the input image, values are lists of strings
+    """
+    ndim = len(shape)
+    vox = tuple(vox) if vox is not None else (1.0,) * ndim
+    vox = vox + (1.0,) * (ndim - len(vox))
+    layout = layout or ",".join("+{}".format(ax) for ax in range(ndim))
+    keyvals = dict(header or {})
+    if transform is not None:
+        keyvals["transform"] = np.asarray(transform, dtype=float)[:3]
+    elif "transform" not in keyvals:
+        keyvals["transform"] = np.eye(4)[:3]
+    if dw_scheme is not None:
+        keyvals["dw_scheme"] = np.asarray(dw_scheme, dtype=float).reshape(-1, 4)
+    text = _format_header(shape, vox[:ndim], layout, np.dtype(dtype), keyvals)
+    nbytes = _nbytes(shape, dtype)
+
+    if fname.endswith(".mih"):
+        data_file = os.path.splitext(fname)[0] + ".dat"
+        with open(fname, "w") as f:
+            f.write(text + "file: {} 0\nEND\n".format(os.path.basename(data_file)))
+        with open(data_file, "wb") as f:
+            f.truncate(nbytes)
+    else:
+        # the data offset is part of the header, align it past the header's own length
+        offset = len(text.encode("utf-8")) + len("file: . \nEND\n")
+        offset += len(str(offset)) + 1
+        offset = (offset + 15) // 16 * 16
+        head = (text + "file: . {}\nEND\n".format(offset)).encode("utf-8")
+        with open(fname, "wb") as f:
+            f.write(head.ljust(offset, b"\0"))
+            f.truncate(offset + nbytes)
+    return MIFImage(fname, mode="r+")
+
+# Cell
+def load_mif(fname, mode="r"):
+    """
+    Load a .mif or .mih image, the data block is memory-mapped and only read when accessed
+    Inputs:
+        - fname (str): .mif or .mih file
+        - mode (str): memory-map mode, 'r' read-only, 'r+' to modify the data in place, 'c' for copy-on-write
+    """
+    return MIFImage(fname, mode=mode)
+
+def save_mif(fname, data, vox=None, transform=None, dw_scheme=None, layout=None, header=None):
+    """
+    Save a numpy array as a .mif or .mih image
+    Inputs:
+        - fname (str): output .mif or .mih file
+        - data (array): image data in (x, y, z, volume) order
+        - vox, transform, dw_scheme, layout, header: see `create_mif`
+    """
+    img = create_mif(
+        fname, data.shape, data.dtype, vox=vox, transform=transform,
+        dw_scheme=dw_scheme, layout=layout, header=header,
+    )
+    img.data[...] = data
+    img.flush()
+    return img
+
+# Internal Cell
+def _link_or_copy(src, dst):
+    "hardlink `src` to `dst`, or copy it when it can't be linked"
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+# Cell
+def set_dw_scheme(in_file, dw_scheme, out_file=None, link_data=False):
+    """
+    Replace the gradient table of a .mif/.mih image without touching its data block.
+    Inputs:
+        - in_file (str): .mif or .mih image
+        - dw_scheme (array or str): N x 4 gradient table, or an MRtrix gradient file
+        - out_file (str): new .mih header referencing the data of `in_file`, or None to update `in_file` in place
+        - link_data (bool): hardlink, or copy, the data of `in_file` next to `out_file` and reference that
+    """
+    if isinstance(dw_scheme, str):
+        dw_scheme = np.loadtxt(dw_scheme, comments="#", ndmin=2)
+    dw_scheme = np.asarray(dw_scheme, dtype=float).reshape(-1, 4)
+    img = MIFImage(in_file)
+    if dw_scheme.shape[0] != img.shape[-1]:
+        raise ValueError(
+            "{} gradient directions for {} volumes in {}".format(dw_scheme.shape[0], img.shape[-1], in_file)
+        )
+    header = dict(img.header, dw_scheme=dw_scheme)
+    text = _format_header(img.shape, img.vox, img.layout, img.dtype, header)
+    data_files = _data_files(in_file, img.header)
+
+    if out_file is None:
+        out_file = in_file
+        if in_file.endswith(".mih"):
+            entries = img.header["file"]
+        else:
+            entries = [". {}".format(data_files[0][1])]
+        head = (text + "".join("file: {}\n".format(e) for e in entries) + "END\n").encode("utf-8")
+        if not in_file.endswith(".mih") and len(head) > data_files[0][1]:
+            raise ValueError("The new header of {} doesn't fit in front of its data, write a .mih instead".format(in_file))
+        with open(in_file, "r+b") as f:
+            if in_file.endswith(".mih"):
+                f.truncate(0)
+            f.write(head)
+        return out_file
+
+    if not out_file.endswith(".mih"):
+        raise ValueError("Gradient tables can only be updated in place or into a .mih header, got {}".format(out_file))
+    out_dir = os.path.dirname(os.path.abspath(out_file))
+    entries = []
+    for i, (data_file, offset) in enumerate(data_files):
+        if link_data:
+            local = os.path.splitext(os.path.abspath(out_file))[0] + (".dat" if len(data_files) == 1 else "_{}.dat".format(i))
+            _link_or_copy(data_file, local)
+            data_file = local
+        entries.append("{} {}".format(os.path.relpath(data_file, out_dir), offset))
+    with open(out_file, "w") as f:
+        f.write(text + "".join("file: {}\n".format(e) for e in entries) + "END\n")
+    return out_file
\ No newline at end of file
@@ -12,22 +12,20 @@ from pathlib import Path
 from itertools import product
 
 import pipetography.core as ppt
+from .dwi import UpdateGradient, MeanB0, DTIMetrics, RicianCorrection
+from .connectivity import ConnectomeMatrices, ParcellationDistance, SampleStreamlines, StreamlineEndpoints
+from .tck import MergeTracks
 
 from nipype import IdentityInterface, Function
-from nipype.interfaces.io import SelectFiles, DataSink
-from nipype.pipeline import Node, MapNode, Workflow
-from nipype.interfaces.mrtrix3.utils import (
-    BrainMask,
-    TensorMetrics,
-    DWIExtract,
-    MRMath,
-)
+from nipype.interfaces.io import SelectFiles
+from nipype.pipeline import Node, MapNode, JoinNode, Workflow
+from nipype.interfaces.mrtrix3.utils import BrainMask
 from nipype.interfaces.mrtrix3.preprocess import MRDeGibbs, DWIBiasCorrect, ResponseSD
 from nipype.interfaces.mrtrix3.reconst import (
-    FitTensor,
     EstimateFOD,
     ConstrainedSphericalDeconvolution,
 )
+from nipype.interfaces.mrtrix3.tracking import Tractography
 from nipype.interfaces import ants
 from nipype.interfaces import fsl
 
@@ -60,17 +58,10 @@ class PreProcNodes:
         ses_list,
         exclude_list=[()],
     ):
-        # filtter & create sub-graphs for subjects and sessions combos
-        sub_iter, ses_iter = ppt.filter_workflow(bids_dir, sub_list, ses_list, exclude_list)
-        # Create BIDS nodes:
-        BIDSFolders = [
-            (
-                "preprocessed/ses-%ssub-%s" % (session, subject),
-                "sub-%s/ses-%s/preprocessed" % (subject, session),
-            )
-            for session in ses_list
-            for subject in sub_list
-        ]
+        # discover existing subjects and sessions combos & create sub-graphs for them
+        self.sub_ses = ppt.discover_sessions(bids_dir, sub_list, ses_list, exclude_list)
+        sub_iter = [sub for sub, _ in self.sub_ses]
+        ses_iter = [ses for _, ses in self.sub_ses]
         # IdentityInterface for file input:
         self.subject_source = Node(
             IdentityInterface(fields=["subject_id", "session_id"]),
@@ -232,7 +223,8 @@ class PreProcNodes:
             ppt.MRInfo(export_grad="modified.b"), name="ModifyGradient"
         )
 
-        self.UpdateMif = Node(ppt.Convert(), name="UpdateMif")
+        # only the gradient table changes, the header references preproc.mif's data
+        self.UpdateMif = Node(UpdateGradient(out_file="dwi.mih"), name="UpdateMif")
 
         self.NewMask = Node(BrainMask(), name="RecreateMask")
 
@@ -251,33 +243,14 @@ class PreProcNodes:
             name="NewGradient",
         )
 
-        self.low_noise_map = Node(
-            ppt.CheckNIZ(out_file="lownoisemap.mif", nthreads=mrtrix_nthreads),
-            name="LowNoiseMap",
-        )
-
-        self.rician_noise = Node(
-            ppt.RicianNoise(
-                power=2,
-                denoise=2,
-                out_file="rician_removed_dwi.mif",
-                nthreads=mrtrix_nthreads,
-            ),
-            name="RicianNoise",
-        )
-
-        self.check_rician = Node(
-            ppt.CheckNIZ(out_file="rician_tmp.mif", nthreads=mrtrix_nthreads),
-            name="NoiseComparison",
-        )
-
-        self.convert_rician = Node(
-            ppt.Convert(out_file="rician_corrected_dwi.mif", nthreads=mrtrix_nthreads),
-            name="ConvertRician",
+        self.rician_correction = Node(
+            RicianCorrection(out_file="rician_corrected_dwi.mif", n_threads=mrtrix_nthreads),
+            name="RicianCorrection",
         )
         self.dwi_mask = Node(BrainMask(out_file="dwi_mask.mif"), name="dwi2mask",)
-        self.fit_tensor = Node(FitTensor(out_file="dti.mif"), name="dwi2tensor",)
-        self.tensor_FA = Node(TensorMetrics(out_fa="fa.mif"), name="tensor2metrics",)
+        self.tensor_FA = Node(
+            DTIMetrics(out_fa="fa.mif", n_threads=mrtrix_nthreads), name="tensor2metrics",
+        )
         self.wm_mask = Node(
             ppt.MRThreshold(opt_abs=0.5, out_file="wm.mif", nthreads=mrtrix_nthreads),
             name="mrthreshold",
@@ -290,46 +263,18 @@ class PreProcNodes:
             ),
             name="DWINormalise",
         )
-        self.sub_b0extract = Node(
-            DWIExtract(bzero=True, out_file="b0_volume.mif", nthreads=mrtrix_nthreads),
-            name="ExtractB0Image",
-        )
         self.sub_b0mean = Node(
-            MRMath(
-                operation="mean",
-                axis=3,
-                out_file="b0_dwi.mif",
-                nthreads=mrtrix_nthreads,
-            ),
+            MeanB0(out_file="b0_dwi.nii.gz", out_masked="b0_dwi_brain.nii.gz"),
             name="MeanB0Volume",
         )
         self.sub_b0mask = Node(
             BrainMask(out_file="dwi_norm_mask.mif", nthreads=mrtrix_nthreads),
             name="DWI2Mask",
         )
-        self.sub_convert_dwi = Node(
-            ppt.Convert(out_file="b0_dwi.nii.gz"), name="DWI2Nifti",
-        )
-        self.sub_convert_mask = Node(
-            ppt.Convert(out_file="dwi_norm_mask.nii.gz"), name="Mask2Nifti",
-        )
-        self.sub_apply_mask = Node(
-            fsl.ApplyMask(out_file="b0_dwi_brain.nii.gz"), name="ApplyMask",
-        )
-        self.mni_b0extract = Node(
-            DWIExtract(
-                bzero=True,
-                out_file="dwi_space-acpc_res-{}_b0.mif".format(img_resol),
-                nthreads=mrtrix_nthreads,
-            ),
-            name="MNIExtractB0Volume",
-        )
         self.mni_b0mean = Node(
-            MRMath(
-                operation="mean",
-                axis=3,
-                out_file="dwi_space-acpc_res-{}_b0mean.mif".format(img_resol),
-                nthreads=mrtrix_nthreads,
+            MeanB0(
+                out_file="dwi_space-acpc_res-{}_b0mean.nii.gz".format(img_resol),
+                out_masked="dwi_space-acpc_res-{}_seg-brain.nii.gz".format(img_resol),
             ),
             name="MNIB0MeanVolume",
         )
@@ -340,24 +285,12 @@ class PreProcNodes:
             ),
             name="MNIB0BrainMask",
         )
-        self.mni_convert_dwi = Node(
-            ppt.Convert(
-                out_file="dwi_space-acpc_res-{}_b0mean.nii.gz".format(img_resol)
-            ),
-            name="MNIDWI2Nifti",
-        )
         self.mni_convert_mask = Node(
             ppt.Convert(
                 out_file="dwi_space-acpc_res-{}_seg-brain_mask.nii.gz".format(img_resol)
             ),
             name="MNIMask2Nifti",
         )
-        self.mni_apply_mask = Node(
-            fsl.ApplyMask(
-                out_file="dwi_space-acpc_res-{}_seg-brain.nii.gz".format(img_resol)
-            ),
-            name="MNIApplyMask",
-        )
         self.mni_dwi = Node(
             ppt.Convert(
                 out_file="dwi_space-acpc_res-{}.nii.gz".format(img_resol),
@@ -373,19 +306,11 @@ class PreProcNodes:
             name="MNI_Outputs",
         )
 
+        # BIDSDataSink maps the sub-graph folders to sub-*/ses-*/preprocessed
         self.datasink = Node(
-            DataSink(
-                base_directory=os.path.join(bids_dir, "derivatives", "pipetography")
-            ),
+            ppt.BIDSDataSink(base_directory=os.path.join(bids_dir, "derivatives", "pipetography")),
             name="DataSink",
         )
-        substitutions = [
-            ("_subject_id_", "sub-"),
-            ("_session_id_", "ses-"),
-            *BIDSFolders,
-        ]
-
-        self.datasink.inputs.substitutions = substitutions
         print(
             "Data sink (output folder) is set to {}".format(
                 os.path.join(bids_dir, "derivatives", "pipetography")
@@ -503,18 +428,11 @@ class PostProcNodes:
     """
 
     def __init__(self, BIDS_dir, subj_template, sub_list, ses_list, skip_tuples):
-        # filter & create sub-graphs for subjects and session combos:
-        sub_iter, ses_iter = ppt.filter_workflow(BIDS_dir, sub_list, ses_list, skip_tuples)
-
-        # Create BIDS output folder list for datasink
-        BIDSFolders = [
-            (
-                "connectomes/ses-%ssub-%s" % (session, subject),
-                "sub-%s/ses-%s/connectomes" % (subject, session),
-            )
-            for session in ses_list
-            for subject in sub_list
-        ]
+        # discover existing subjects and session combos & create sub-graphs for them:
+        self.sub_ses = ppt.discover_sessions(BIDS_dir, sub_list, ses_list, skip_tuples)
+        sub_iter = [sub for sub, _ in self.sub_ses]
+        ses_iter = [ses for _, ses in self.sub_ses]
+
         # BIDS derivatives directory containing preprocessed outputs and streamline outputs
         preproc_dir = os.path.join(
             BIDS_dir, "derivatives", "pipetography"
@@ -574,6 +492,37 @@ class PostProcNodes:
             ),
             name="NonLinearRegistration",
         )
+        # register the template to the subject once, then warp each atlas with the composite transform
+        self.template_reg = Node(
+            ants.Registration(
+                output_transform_prefix="template_in_dwi",
+                dimension=3,
+                collapse_output_transforms=True,
+                write_composite_transform=True,
+                transforms=["Affine", "SyN"],
+                transform_parameters=[(0.1,), (0.1,)],
+                metric=["MI", "MI"],
+                metric_weight=[1, 1],
+                radius_or_number_of_bins=[64, 64],
+                number_of_iterations=[[500, 200, 200, 100], [500, 200, 200, 100]],
+                convergence_threshold=[1e-6, 1e-6],
+                convergence_window_size=[10, 10],
+                smoothing_sigmas=[[4, 2, 1, 0], [4, 2, 1, 0]],
+                sigma_units=["vox", "vox"],
+                shrink_factors=[[8, 4, 2, 1], [8, 4, 2, 1]],
+                use_histogram_matching=[True, True],
+                output_warped_image="template_in_dwi.nii.gz",
+            ),
+            name="TemplateRegistration",
+        )
+        self.warp_atlas = Node(
+            ants.ApplyTransforms(
+                dimension=3,
+                interpolation="GenericLabel",
+                output_image="atlas_in_dwi_syn.nii.gz",
+            ),
+            name="WarpAtlas",
+        )
         self.response = Node(
             ResponseSD(
                 algorithm="dhollander",
@@ -594,20 +543,38 @@ class PostProcNodes:
             ),
             name="dwiFOD",
         )
+        # tractography seeded in the GMWMI mask, in shards with their own random seeds (`select` and `environ` per shard)
+        self.tckgen = MapNode(
+            Tractography(algorithm="iFOD2", nthreads=1, out_file="tracks.tck"),
+            iterfield=["select", "environ"],
+            name="tckgen",
+        )
+        self.merge_tck = Node(MergeTracks(out_file="gmwmi2wm.tck"), name="MergeTracks")
+        # merged tractogram goes where the connectome workflow looks for streamlines
+        self.tck_sink = Node(
+            ppt.BIDSDataSink(base_directory=os.path.join(BIDS_dir, "derivatives", "streamlines")),
+            name="tck_sink",
+        )
+        self.tck_sink.inputs.regexp_substitutions = [
+            (r"sub-([^/]+)/ses-([^/]+)/tractography/gmwmi2wm\.tck$", r"sub-\1/ses-\2/sub-\1_ses-\2_gmwmi2wm.tck"),
+        ]
         self.sift2 = Node(
             ppt.tckSIFT2(
-                out_file="sift2.txt"
+                out_file="sift2.txt", out_npy=True
             ),
             name="SIFT2",
         )
-        self.fit_tensor = Node(FitTensor(out_file="dti.mif"), name="dwi2tensor",)
-        self.tensor_FA = Node(TensorMetrics(out_fa="fa.mif"), name="tensor2metrics",)
+        self.tensor_FA = Node(DTIMetrics(out_fa="fa.mif"), name="tensor2metrics",)
         self.tcksample = Node(
             ppt.TckSample(
                 out_file="mean_FA_per_streamline.csv", stat_tck="mean",
             ),
             name="TckSample",
         )
+        # mean FA per streamline for the native connectomes, more metrics can be sampled in the same pass
+        self.sample_metrics = Node(
+            SampleStreamlines(metric_names=["FA"], stats=["mean"]), name="SampleStreamlines",
+        )
         self.connectome = Node(
             ppt.MakeConnectome(
                 out_file="connectome.csv", symmetric=True, zero_diag=True
@@ -633,12 +600,30 @@ class PostProcNodes:
             ),
             name="WeightFA",
         )
-        self.datasink = Node(DataSink(base_directory=preproc_dir), name="datasink")
-        substitutions = [("_subject_id_", "sub-"), ("_session_id_", "ses-")]
-        substitutions.extend(BIDSFolders)
-        self.datasink.inputs.substitutions = substitutions
+        # endpoint index next to the tractogram, reused by every atlas and weighting
+        self.endpoints = Node(StreamlineEndpoints(), name="StreamlineEndpoints")
+        # distance transform of each warped atlas, for the radial search of ConnectomeMatrices
+        self.parc_distance = Node(ParcellationDistance(), name="ParcellationDistance")
+        # count, distance and FA weighted connectomes of every atlas from the endpoint index
+        self.connectome_matrices = JoinNode(
+            ConnectomeMatrices(
+                out_count="connectome.csv",
+                out_length="distances.csv",
+                out_scale="FA_weighted.csv",
+                search_radius=4.0,
+            ),
+            joinsource="LinearRegistration",
+            joinfield=["in_parc", "in_distance"],
+            name="ConnectomeMatrices",
+        )
+        # BIDSDataSink maps the sub-graph folders to sub-*/ses-*/connectomes
+        self.datasink = Node(
+            ppt.BIDSDataSink(base_directory=preproc_dir),
+            name="datasink",
+        )
         self.datasink.inputs.regexp_substitutions = [
-            (r"(_moving_image_.*\.\.)", ""),
+            (r"(_(moving|input)_image_.*\.\.)", ""),
             (r"(\.nii|\.gz)", ""),
+            (r"/_atlas_", "/"),
         ]
         print("Data sink (output folder) is set to {}".format(preproc_dir))
\ No newline at end of file
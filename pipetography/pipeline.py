@@ -13,6 +13,7 @@ from nipype.pipeline import Workflow
 
 import pipetography.core as ppt
 import pipetography.nodes as nodes
+from .execution import run_batched, apply_resource_profiles, CriticalPathPlugin, _batch_share
 
 # Cell
 class pipeline:
@@ -24,9 +25,10 @@ class pipeline:
         - rpe_design (str): Reverse phase encoding design for your DWI acquisition. Also supports '-rpe_all', default is "-rpe_none"
         - regrid (bool): Whether  to resample DWI to  1mm MNI template, defaults to True.
         - gmwmi (bool): Segment for gray matter white matter interface (GMWMI) with FSL first, defaults to False.
-        - mrtrix_nthreads (int): Number of threads for mrtrix3 algorithm. If zero, the number of available CPUs will be used. Default is 0.
+        - mrtrix_nthreads (int): Number of threads for mrtrix3 algorithm. If zero, the number of available CPUs will be used. Default is 0. When running in parallel, each node's threads come from its resource profile (`execution.RESOURCE_PROFILES`), capped to this number if it isn't zero.
         - skip_tuples (list[tuple]): A combination of [('subject #', 'session #')] tuples to skip, example: [('01', '03')] will skip sub-01/ses-03. Used for missinng data, the pipeline will automatically remove inconsistent sessions from BIDS Layout.
         - debug (bool): Default = False; if True, saves node outputs and log files.
+        - sink_transfer (str): how outputs are placed in the derivatives folder, see `core.BIDSDataSink`. Default is "copy"; "hardlink" avoids writing large outputs twice, but the derivatives then share their data with the working directory files.
     """
 
     def __init__(
@@ -38,7 +40,8 @@ class pipeline:
         gmwmi = False,
         mrtrix_nthreads=0,
         skip_tuples=[()],
-        debug=False
+        debug=False,
+        sink_transfer="copy",
     ):
         self.bids_dir = BIDS_dir
         self.rpe_design = rpe_design
@@ -48,6 +51,7 @@ class pipeline:
         self.ext = ext
         self.excludes = skip_tuples
         self.debug_mode = debug
+        self.sink_transfer = sink_transfer
         self.MNI_template = os.path.expandvars(
             "$FSLDIR/data/standard/MNI152_T1_1mm.nii.gz"
         )
@@ -152,6 +156,7 @@ class pipeline:
             ses_list=self.ses_list,
             exclude_list=self.excludes,
         )
+        self.PreProcNodes.datasink.inputs.transfer = self.sink_transfer
         self.ACPCNodes = nodes.ACPCNodes(MNI_template=self.MNI_template)
         self.workflow = None
 
@@ -277,9 +282,9 @@ class pipeline:
                     [("out_file", "t1_brain")],
                 ),
                 (
-                    self.PreProcNodes.sub_apply_mask,
+                    self.PreProcNodes.sub_b0mean,
                     self.ACPCNodes.epi_reg,
-                    [("out_file", "epi")],
+                    [("out_masked", "epi")],
                 ),
                 (
                     self.ACPCNodes.epi_reg,
@@ -287,9 +292,9 @@ class pipeline:
                     [("epi2str_mat", "flirt_xfm")],
                 ),
                 (
-                    self.PreProcNodes.sub_apply_mask,
+                    self.PreProcNodes.sub_b0mean,
                     self.ACPCNodes.acpc_xfm,
-                    [("out_file", "flirt_in")],
+                    [("out_masked", "flirt_in")],
                 ),
                 (
                     self.ACPCNodes.t1_bet,
@@ -415,61 +420,31 @@ class pipeline:
                 ),
                 (
                     self.PreProcNodes.denoise,
-                    self.PreProcNodes.low_noise_map,
-                    [("noise", "isfinite")],
-                ),
-                (
-                    self.PreProcNodes.denoise,
-                    self.PreProcNodes.low_noise_map,
-                    [("noise", "cond_if")],
-                ),
-                (
-                    self.PreProcNodes.low_noise_map,
-                    self.PreProcNodes.rician_noise,
-                    [("out_file", "lownoisemap")],
+                    self.PreProcNodes.rician_correction,
+                    [("noise", "noise_file")],
                 ),
                 (
                     self.PreProcNodes.biascorrect,
-                    self.PreProcNodes.rician_noise,
-                    [("out_file", "in_file")],
-                ),
-                (
-                    self.PreProcNodes.rician_noise,
-                    self.PreProcNodes.check_rician,
-                    [("out_file", "isfinite")],
-                ),
-                (
-                    self.PreProcNodes.rician_noise,
-                    self.PreProcNodes.check_rician,
-                    [("out_file", "cond_if")],
-                ),
-                (
-                    self.PreProcNodes.check_rician,
-                    self.PreProcNodes.convert_rician,
+                    self.PreProcNodes.rician_correction,
                     [("out_file", "in_file")],
                 ),
                 (
                     self.PreProcNodes.grad_info,
-                    self.PreProcNodes.convert_rician,
+                    self.PreProcNodes.rician_correction,
                     [("out_bfile", "grad_file")],
                 ),
                 (
-                    self.PreProcNodes.convert_rician,
+                    self.PreProcNodes.rician_correction,
                     self.PreProcNodes.dwi_mask,
                     [("out_file", "in_file")],
                 ),
                 (
                     self.PreProcNodes.dwi_mask,
-                    self.PreProcNodes.fit_tensor,
-                    [("out_file", "in_mask")],
-                ),
-                (
-                    self.PreProcNodes.convert_rician,
-                    self.PreProcNodes.fit_tensor,
-                    [("out_file", "in_file")],
+                    self.PreProcNodes.tensor_FA,
+                    [("out_file", "mask_file")],
                 ),
                 (
-                    self.PreProcNodes.fit_tensor,
+                    self.PreProcNodes.rician_correction,
                     self.PreProcNodes.tensor_FA,
                     [("out_file", "in_file")],
                 ),
@@ -484,74 +459,39 @@ class pipeline:
                     [("out_file", "mask_file")],
                 ),
                 (
-                    self.PreProcNodes.convert_rician,
+                    self.PreProcNodes.rician_correction,
                     self.PreProcNodes.norm_intensity,
                     [("out_file", "in_file")],
                 ),
                 (
                     self.PreProcNodes.norm_intensity,
-                    self.PreProcNodes.sub_b0extract,
-                    [("out_file", "in_file")],
-                ),
-                (
-                    self.PreProcNodes.sub_b0extract,
                     self.PreProcNodes.sub_b0mean,
                     [("out_file", "in_file")],
                 ),
                 (
-                    self.PreProcNodes.norm_intensity,
                     self.PreProcNodes.sub_b0mask,
-                    [("out_file", "in_file")],
-                ),
-                (
-                    self.PreProcNodes.sub_b0mask,
-                    self.PreProcNodes.sub_convert_mask,
-                    [("out_file", "in_file")],
-                ),
-                (
                     self.PreProcNodes.sub_b0mean,
-                    self.PreProcNodes.sub_convert_dwi,
-                    [("out_file", "in_file")],
-                ),
-                (
-                    self.PreProcNodes.sub_convert_dwi,
-                    self.PreProcNodes.sub_apply_mask,
-                    [("out_file", "in_file")],
-                ),
-                (
-                    self.PreProcNodes.sub_convert_mask,
-                    self.PreProcNodes.sub_apply_mask,
                     [("out_file", "mask_file")],
                 ),
                 (
-                    self.PreProcNodes.mni_b0extract,
-                    self.PreProcNodes.mni_b0mean,
+                    self.PreProcNodes.norm_intensity,
+                    self.PreProcNodes.sub_b0mask,
                     [("out_file", "in_file")],
                 ),
                 (
                     self.PreProcNodes.mni_b0mask,
-                    self.PreProcNodes.mni_convert_mask,
-                    [("out_file", "in_file")],
-                ),
-                (
                     self.PreProcNodes.mni_b0mean,
-                    self.PreProcNodes.mni_convert_dwi,
-                    [("out_file", "in_file")],
-                ),
-                (
-                    self.PreProcNodes.mni_convert_mask,
-                    self.PreProcNodes.mni_apply_mask,
                     [("out_file", "mask_file")],
                 ),
                 (
-                    self.PreProcNodes.mni_convert_dwi,
-                    self.PreProcNodes.mni_apply_mask,
+                    self.PreProcNodes.mni_b0mask,
+                    self.PreProcNodes.mni_convert_mask,
                     [("out_file", "in_file")],
                 ),
                 (
-                    self.PreProcNodes.mni_apply_mask,
+                    self.PreProcNodes.mni_b0mean,
                     self.PreProcNodes.datasink,
-                    [("out_file", "preprocessed.@dwi_brain")],
+                    [("out_masked", "preprocessed.@dwi_brain")],
                 ),
                 (
                     self.PreProcNodes.mni_convert_mask,
@@ -559,7 +499,7 @@ class pipeline:
                     [("out_file", "preprocessed.@dwi_b0_brainmask")],
                 ),
                 (
-                    self.PreProcNodes.mni_convert_dwi,
+                    self.PreProcNodes.mni_b0mean,
                     self.PreProcNodes.datasink,
                     [("out_file", "preprocessed.@dwi_b0_meanvolume")],
                 ),
@@ -788,7 +728,7 @@ class pipeline:
                     ),
                     (
                         self.ACPCNodes.regrid,
-                        self.PreProcNodes.mni_b0extract,
+                        self.PreProcNodes.mni_b0mean,
                         [("out_file", "in_file")],
                     ),
                     (
@@ -808,7 +748,7 @@ class pipeline:
                 [
                     (
                         self.ACPCNodes.apply_xfm,
-                        self.PreProcNodes.mni_b0extract,
+                        self.PreProcNodes.mni_b0mean,
                         [("out_file", "in_file")],
                     ),
                     (
@@ -850,10 +790,52 @@ class pipeline:
             ),
         )
 
-    def run_pipeline(self, parallel=None):
+    def run_pipeline(self, parallel=None, batch_size=None, batches_in_flight=1, memory_gb=None, profiles=None, critical_path=False, max_sessions=None, cleanup=False, scheduler_args=None):
+        """
+        Run nipype workflow
+        Inputs:
+            - parallel (int): number of CPUs shared by the nodes running in parallel, runs serially if None
+            - batch_size (int): if given, runs the sessions in batches of this size so only a batch's graph is expanded at a time, see `execution.run_batched`
+            - batches_in_flight (int): number of batches running at once, sharing the `parallel` processes
+            - memory_gb (float): memory shared by the nodes running in parallel, defaults to what nipype detects. Node memory profiles are capped to it
+            - profiles (dict): with `parallel`, {node name: (threads, mem_gb, io_weight)} overriding `execution.RESOURCE_PROFILES`
+            - critical_path (bool): with `parallel`, starts the nodes with the longest remaining path first, see `execution.CriticalPathPlugin`
+            - max_sessions (int): with `parallel`, number of sessions in flight, each session finishes before new ones start
+            - cleanup (bool): with `parallel`, deletes the large outputs of each node once the nodes using them are done, instead of removing node directories at the end
+            - scheduler_args (dict): `CriticalPathPlugin` arguments, e.g. {"history_file": "runtimes.json", "io_slots": 2}
+        """
         if type(parallel) == int:
             print("Running workflow with {} parallel processes".format(parallel))
-            self.workflow.run("MultiProc", plugin_args={"n_procs": parallel})
+            plugin, plugin_args = "MultiProc", {"n_procs": parallel}
+            if memory_gb:
+                plugin_args["memory_gb"] = memory_gb
+            if critical_path or max_sessions or cleanup:
+                plugin = CriticalPathPlugin
+                plugin_args["max_sessions"] = max_sessions
+                plugin_args["cleanup"] = cleanup
+                plugin_args.update(scheduler_args or {})
+            if cleanup:
+                self.workflow.config["execution"]["remove_node_directories"] = "False"
+            # batches in flight split the CPUs and memory, see `execution.run_batched`
+            n_procs, node_memory_gb = _batch_share(
+                min(parallel, self.mrtrix_nthreads or parallel), memory_gb, batches_in_flight if batch_size else 1
+            )
+            apply_resource_profiles(self.workflow, n_procs=n_procs, memory_gb=node_memory_gb, profiles=profiles)
         elif parallel is None:
             print("Parallel processing is not enabled, running workflow serially.")
-            self.workflow.run()
\ No newline at end of file
+            plugin, plugin_args = "Linear", {}
+        else:
+            raise ValueError("parallel must be a number of processes or None, not {!r}".format(parallel))
+        if batch_size:
+            print("Running sessions in batches of {}".format(batch_size))
+            run_batched(
+                self.workflow,
+                self.PreProcNodes.subject_source,
+                self.PreProcNodes.sub_ses,
+                batch_size=batch_size,
+                batches_in_flight=batches_in_flight,
+                plugin=plugin,
+                plugin_args=plugin_args,
+            )
+        else:
+            self.workflow.run(plugin if isinstance(plugin, str) else plugin(plugin_args=plugin_args), plugin_args=plugin_args)
\ No newline at end of file
@@ -0,0 +1,275 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 06_tck.ipynb (unless otherwise specified).
+
+__all__ = ['TckFile', 'load_tck', 'save_tck', 'merge_tck', 'MergeTracksInputSpec', 'MergeTracksOutputSpec',
+           'MergeTracks', 'tck_endpoints']
+
+# Internal Cell
+import os
+import numpy as np
+
+from nipype.interfaces.base import (
+    BaseInterface,
+    BaseInterfaceInputSpec,
+    File,
+    InputMultiObject,
+    TraitedSpec,
+    traits,
+)
+from .mif import _np_dtype, _read_header
+
+# Internal Cell
+_INDEX_VERSION = 1
+
+def _scan_delimiters(points, chunk_points):
+    "row indices of the NaN delimiters, and the row of the Inf end of file marker (or the number of rows)"
+    delimiters = []
+    for start in range(0, len(points), chunk_points):
+        x = np.asarray(points[start : start + chunk_points, 0])
+        end = np.flatnonzero(np.isinf(x))
+        if end.size:
+            delimiters.append(np.flatnonzero(np.isnan(x[: end[0]])) + start)
+            return np.concatenate(delimiters), start + end[0]
+        delimiters.append(np.flatnonzero(np.isnan(x)) + start)
+    return np.concatenate(delimiters) if delimiters else np.zeros(0, dtype=np.int64), len(points)
+
+def _format_tck_header(header, count, datatype="Float32LE"):
+    "header block of a .tck file of `count` streamlines, padded to its 16-byte aligned data offset"
+    lines = ["mrtrix tracks", "datatype: {}".format(datatype), "count: {:010d}".format(count)]
+    for key, values in (header or {}).items():
+        if key not in ("datatype", "count", "file"):
+            lines.extend("{}: {}".format(key, v) for v in values)
+    text = "\n".join(lines) + "\n"
+    offset = len(text.encode("utf-8")) + len("file: . \nEND\n")
+    offset += len(str(offset)) + 1
+    offset = (offset + 15) // 16 * 16
+    return (text + "file: . {}\nEND\n".format(offset)).encode("utf-8").ljust(offset, b"\0")
+
+def _file_signature(fname):
+    stat = os.stat(fname)
+    return np.array([_INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+# Cell
+class TckFile:
+    """
+    Memory-mapped MRtrix .tck tractogram with an index of its streamlines.
+    Inputs:
+        - fname (str): .tck file
+        - index_file (str): offset index sidecar, defaults to `<fname>.idx.npz`, None to not save it
+        - chunk_points (int): number of points scanned at a time when building the index
+    """
+    def __init__(self, fname, index_file="", chunk_points=2 ** 24):
+        self.fname = fname
+        self.header, _ = _read_header(fname, magic=b"mrtrix tracks")
+        self.dtype = _np_dtype(self.header["datatype"][0])
+        data_file, _, offset = self.header["file"][0].partition(" ")
+        if data_file != ".":
+            raise ValueError("{}: track data in a separate file is not supported".format(fname))
+        n_points = (os.path.getsize(fname) - int(offset)) // (3 * self.dtype.itemsize)
+        self.points = np.memmap(fname, dtype=self.dtype, mode="r", offset=int(offset), shape=(n_points, 3))
+        self.index_file = fname + ".idx.npz" if index_file == "" else index_file
+        self._delimiters = self._load_index(chunk_points)
+        # streamline k spans rows _starts[k] to _delimiters[k] of the point block
+        self._starts = np.concatenate([[0], self._delimiters + 1])[: len(self._delimiters)]
+
+    def _load_index(self, chunk_points):
+        signature = _file_signature(self.fname)
+        if self.index_file and os.path.exists(self.index_file):
+            with np.load(self.index_file) as index:
+                if np.array_equal(index["signature"], signature):
+                    return index["delimiters"]
+        delimiters, _ = _scan_delimiters(self.points, chunk_points)
+        if self.index_file:
+            try:
+                with open(self.index_file, "wb") as f:
+                    np.savez(f, signature=signature, delimiters=delimiters)
+            except OSError:
+                pass
+        return delimiters
+
+    def __len__(self):
+        return len(self._delimiters)
+
+    @property
+    def lengths(self):
+        "number of points of each streamline"
+        return self._delimiters - self._starts
+
+    def streamline(self, i):
+        "points of streamline `i`, a read-only view of the file"
+        return self.points[self._starts[i] : self._delimiters[i]]
+
+    def streamlines(self, i, j):
+        "streamlines `i` to `j` (excluded) as flat points and their offsets"
+        i, j = max(0, i), min(j, len(self))
+        if i >= j:
+            return np.zeros((0, 3), dtype=self.dtype), np.zeros(1, dtype=np.int64)
+        block = np.asarray(self.points[self._starts[i] : self._delimiters[j - 1]])
+        points = np.delete(block, self._delimiters[i : j - 1] - self._starts[i], axis=0)
+        offsets = np.concatenate([[0], np.cumsum(self.lengths[i:j])])
+        return points, offsets
+
+    def batches(self, batch_size=100000):
+        "iterate over the tractogram `batch_size` streamlines at a time, as (first streamline, points, offsets)"
+        for i in range(0, len(self), batch_size):
+            points, offsets = self.streamlines(i, i + batch_size)
+            yield i, points, offsets
+
+# Cell
+def load_tck(fname, index_file=""):
+    """
+    Open a .tck tractogram, building or loading its streamline index
+    Inputs:
+        - fname (str): .tck file
+        - index_file (str): offset index sidecar, defaults to `<fname>.idx.npz`, None to not save it
+    """
+    return TckFile(fname, index_file=index_file)
+
+def save_tck(fname, points, offsets, header=None):
+    """
+    Write streamlines given as flat points and offsets to a .tck file
+    Inputs:
+        - fname (str): output .tck file
+        - points (array): N x 3 points in scanner coordinates (mm)
+        - offsets (array): start of each streamline in `points`, followed by N
+        - header (dict): other header keys, values are lists of strings
+    """
+    points = np.asarray(points, dtype="<f4").reshape(-1, 3)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    count = len(offsets) - 1
+    data = np.full((len(points) + count + 1, 3), np.nan, dtype="<f4")
+    # each streamline is followed by a NaN delimiter row
+    data[np.arange(len(points)) + np.repeat(np.arange(count), np.diff(offsets))] = points
+    data[-1] = np.inf
+    with open(fname, "wb") as f:
+        f.write(_format_tck_header(header, count))
+        data.tofile(f)
+    return fname
+
+# Internal Cell
+# header keys of tractography shards that add up in the merged tractogram
+_SUMMED_KEYS = ("total_count", "select", "max_num_seeds")
+
+def _merge_headers(headers):
+    "header of tractograms merged together: summed counts, the keys all of them share, without per-shard keys"
+    merged = {}
+    for key, values in headers[0].items():
+        if key in ("count", "file"):
+            continue
+        if key in _SUMMED_KEYS:
+            if all(key in h for h in headers):
+                merged[key] = [str(sum(int(float(h[key][0])) for h in headers))]
+        elif all(h.get(key) == values for h in headers[1:]):
+            merged[key] = values
+    return merged
+
+# Cell
+def merge_tck(in_files, out_file, chunk_size=2 ** 26):
+    """
+    Concatenate .tck tractograms, streaming their data into `out_file` under a new header
+    Inputs:
+        - in_files (list): .tck files of the same datatype
+        - out_file (str): output .tck file
+        - chunk_size (int): number of bytes copied at a time
+    """
+    headers, blocks = [], []
+    for fname in in_files:
+        header, _ = _read_header(fname, magic=b"mrtrix tracks")
+        data_file, _, offset = header["file"][0].partition(" ")
+        if data_file != ".":
+            raise ValueError("{}: track data in a separate file is not supported".format(fname))
+        dtype = _np_dtype(header["datatype"][0])
+        end = os.path.getsize(fname) - 3 * dtype.itemsize
+        if end < int(offset) or not np.all(np.isinf(np.fromfile(fname, dtype=dtype, count=3, offset=end))):
+            raise ValueError("{}: no end of file marker, the tractogram is incomplete".format(fname))
+        headers.append(header)
+        blocks.append((fname, int(offset), end))
+    datatypes = {header["datatype"][0] for header in headers}
+    if len(datatypes) != 1:
+        raise ValueError("cannot merge tractograms of datatypes {}".format(", ".join(sorted(datatypes))))
+    header = _merge_headers(headers)
+    count = sum(int(h["count"][0]) for h in headers)
+    with open(out_file, "wb") as out:
+        out.write(_format_tck_header(header, count, datatype=header["datatype"][0]))
+        for fname, start, end in blocks:
+            with open(fname, "rb") as f:
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    out.write(chunk)
+                    remaining -= len(chunk)
+        out.write(np.full(3, np.inf, dtype=_np_dtype(header["datatype"][0])).tobytes())
+    return out_file
+
+class MergeTracksInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiObject(File(exists=True), mandatory=True, desc="input tck files")
+    out_file = File("merged.tck", usedefault=True, desc="output tck file")
+
+class MergeTracksOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="merged tck file")
+
+class MergeTracks(BaseInterface):
+    """
+    Merge tractograms (e.g. tractography shards) into one, rewriting only the header
+    """
+    input_spec = MergeTracksInputSpec
+    output_spec = MergeTracksOutputSpec
+
+    def _run_interface(self, runtime):
+        merge_tck(list(self.inputs.in_files), os.path.abspath(self.inputs.out_file))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["out_file"] = os.path.abspath(self.inputs.out_file)
+        return outputs
+
+# Internal Cell
+def _streamline_lengths(points, offsets):
+    "length in mm of each streamline given as flat points and offsets"
+    steps = np.zeros(len(points))
+    steps[1:] = np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1), dtype=np.float64)
+    lengths = np.zeros(len(offsets) - 1)
+    valid = offsets[1:] > offsets[:-1]
+    lengths[valid] = steps[offsets[1:][valid] - 1] - steps[offsets[:-1][valid]]
+    return lengths
+
+def _extract_endpoints(tck, batch_size):
+    columns = {
+        "start": np.full((len(tck), 3), np.nan, dtype=np.float32),
+        "end": np.full((len(tck), 3), np.nan, dtype=np.float32),
+        "length": np.zeros(len(tck), dtype=np.float32),
+        "n_points": tck.lengths.astype(np.int32),
+    }
+    for first, points, offsets in tck.batches(batch_size):
+        batch = np.arange(first, first + len(offsets) - 1)
+        valid = offsets[1:] > offsets[:-1]
+        columns["start"][batch[valid]] = points[offsets[:-1][valid]]
+        columns["end"][batch[valid]] = points[offsets[1:][valid] - 1]
+        columns["length"][batch] = _streamline_lengths(points, offsets)
+    return columns
+
+# Cell
+def tck_endpoints(tck_file, endpoints_file="", batch_size=1000000):
+    """
+    First and last point, length (mm) and number of points of every streamline, read from the endpoint index of a tractogram,
+    which is created when it doesn't exist or is older than the tractogram.
+    Inputs:
+        - tck_file (str): .tck file
+        - endpoints_file (str): endpoint index, defaults to `<tck_file>.endpoints.npz`, None to not save it
+        - batch_size (int): number of streamlines read at a time when creating the index
+    """
+    endpoints_file = tck_file + ".endpoints.npz" if endpoints_file == "" else endpoints_file
+    signature = _file_signature(tck_file)
+    if endpoints_file and os.path.exists(endpoints_file):
+        with np.load(endpoints_file) as index:
+            if np.array_equal(index["signature"], signature):
+                return {key: index[key] for key in ("start", "end", "length", "n_points")}
+    columns = _extract_endpoints(TckFile(tck_file), batch_size)
+    if endpoints_file:
+        try:
+            with open(endpoints_file, "wb") as f:
+                np.savez(f, signature=signature, **columns)
+        except OSError:
+            pass
+    return columns
\ No newline at end of file